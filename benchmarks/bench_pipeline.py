@@ -0,0 +1,231 @@
+"""Times each stage of parse -> enqueue -> update -> draw -> send on generated songs.
+
+    python benchmarks/bench_pipeline.py --out results.json
+    python benchmarks/bench_pipeline.py --compare before.json after.json
+
+Runs on Linux with the SDL dummy driver and a stand-in for kernel32, so results
+from different commits on the same machine can be compared.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import typing as T
+
+import numpy as np
+
+import headless
+import read_notes
+from interception_py import interception as interception_module
+from interception_py.interception import interception
+from interception_py.interception_sender import InterceptionSender
+from interception_py.stroke import key_stroke
+
+# name -> (notes per second, seconds)
+FIXTURES: T.Dict[str, T.Tuple[float, float]] = {
+    "sparse_1min": (4.0, 60.0),
+    "medium_3min": (16.0, 180.0),
+    "dense_10min": (64.0, 600.0),
+}
+WHITE_KEYS = [48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72, 74, 76, 77, 79, 81, 83]
+FPS = 60.0
+
+
+class FakeKernel32:
+    # Just enough of kernel32 for interception() and device.send() to run
+    def __init__(self):
+        self._next_handle = 100
+
+    def CreateFileA(self, *args):
+        self._next_handle += 1
+        return self._next_handle
+
+    def CreateEventA(self, *args):
+        self._next_handle += 1
+        return self._next_handle
+
+    def DeviceIoControl(self, *args):
+        return 1
+
+    def WaitForMultipleObjects(self, *args):
+        return 1
+
+    def CloseHandle(self, *args):
+        return 1
+
+
+def generate_notes(notes_per_sec: float, seconds: float, seed: int = 0) -> T.List[T.Tuple[int, float]]:
+    rng = np.random.default_rng(seed)
+    n = int(notes_per_sec * seconds)
+    onsets = np.sort(rng.uniform(0, seconds, n))
+    pitches = rng.choice(WHITE_KEYS, n)
+    lengths = rng.uniform(0.05, 0.5, n)
+    notes: T.List[T.Tuple[int, float]] = []
+    # Keep each pitch's notes from overlapping, so on/off stay paired
+    free_at: T.Dict[int, float] = {}
+    for pitch, onset, length in zip(pitches.tolist(), onsets.tolist(), lengths.tolist()):
+        onset = max(onset, free_at.get(pitch, 0.0))
+        notes.append((pitch, onset))
+        notes.append((pitch, onset + length))
+        free_at[pitch] = onset + length + 0.01
+    return notes
+
+
+def timed(fn: T.Callable[[], T.Any], repeat: int) -> T.Dict[str, float]:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {"min": min(runs), "median": statistics.median(runs), "repeat": repeat}
+
+
+def per_unit(total: T.Dict[str, float], n: int, unit: str = "frames") -> T.Dict[str, float]:
+    return {
+        "min": total["min"] / n,
+        "median": total["median"] / n,
+        "repeat": total["repeat"],
+        unit: n,
+    }
+
+
+def make_sender() -> InterceptionSender:
+    interception_module.k32 = FakeKernel32()
+    sender = InterceptionSender()
+    # Skip calibrate(), which waits for a real key press
+    sender.c = interception()
+    sender.device = 1
+    sender.sample_down = key_stroke(0, 0, 0)
+    sender.sample_up = key_stroke(0, 1, 0)
+    return sender
+
+
+def bench_fixture(fname: str, repeat: int) -> T.Dict[str, T.Any]:
+    results: T.Dict[str, T.Any] = {}
+
+    def parse():
+        read_notes.invalidate_song_cache(fname)
+        return read_notes.read_midi_file(fname)
+
+    results["read_midi_file"] = timed(parse, repeat)
+    notes = parse()
+    results["autotranspose"] = timed(lambda: read_notes.autotranspose(notes), repeat)
+
+    game, clock = headless.make_headless_renderer()
+    headless.enqueue_song(game, fname)
+    name = os.path.splitext(os.path.basename(fname))[0].lower()
+    results["enqueue_file"] = timed(lambda: game.enqueue_file(name, clear_existing=True), repeat)
+
+    # Play the whole song once, timing update and draw separately
+    game.enqueue_file(name, clear_existing=True)
+    n_frames = int((game.enqueue_at + 1.0) * FPS)
+    update_runs, draw_runs = [], []
+    for _ in range(repeat):
+        game.enqueue_file(name, clear_existing=True)
+        game.update()
+        update_total = 0.0
+        draw_total = 0.0
+        for _ in range(n_frames):
+            clock.advance(1.0 / FPS)
+            start = time.perf_counter()
+            game.update()
+            mid = time.perf_counter()
+            game.draw()
+            update_total += mid - start
+            draw_total += time.perf_counter() - mid
+        update_runs.append(update_total)
+        draw_runs.append(draw_total)
+    results["update_per_frame"] = per_unit({"min": min(update_runs), "median": statistics.median(update_runs), "repeat": repeat}, n_frames)
+    results["draw_per_frame"] = per_unit({"min": min(draw_runs), "median": statistics.median(draw_runs), "repeat": repeat}, n_frames)
+
+    out_fname = fname + ".out.midi"
+    results["dump_midi_file"] = timed(lambda: read_notes.dump_midi_file(notes, out_fname), repeat)
+    os.remove(out_fname)
+
+    sender = make_sender()
+    keys = [chr(c) for c in b"zxcvbnmasdfghjqwertyu"]
+
+    def send_strokes():
+        for key in keys * 100:
+            sender.keyDown(key)
+            sender.keyUp(key)
+
+    stroke_total = timed(send_strokes, repeat)
+    results["stroke_per_key"] = per_unit(stroke_total, len(keys) * 100 * 2, "strokes")
+    results["n_events"] = len(notes)
+    return results
+
+
+def git_revision() -> T.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat: int, fixtures: T.List[str]) -> T.Dict[str, T.Any]:
+    report: T.Dict[str, T.Any] = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "fixtures": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in fixtures:
+            notes_per_sec, seconds = FIXTURES[name]
+            fname = os.path.join(tmp, f"{name}.mid")
+            read_notes.dump_midi_file(generate_notes(notes_per_sec, seconds), fname)
+            report["fixtures"][name] = bench_fixture(fname, repeat)
+    return report
+
+
+def compare(before_fname: str, after_fname: str):
+    with open(before_fname) as f:
+        before = json.load(f)
+    with open(after_fname) as f:
+        after = json.load(f)
+    print(f"{before['revision']} -> {after['revision']}")
+    for fixture, stages in after["fixtures"].items():
+        if fixture not in before["fixtures"]:
+            continue
+        for stage, timing in stages.items():
+            old = before["fixtures"][fixture].get(stage, None)
+            if not isinstance(timing, dict) or not isinstance(old, dict):
+                continue
+            ratio = timing["median"] / old["median"] if old["median"] else float("inf")
+            print(f"{fixture:>14} {stage:>18}: {old['median'] * 1000:10.3f}ms -> {timing['median'] * 1000:10.3f}ms  x{ratio:.2f}")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=None, help="Write results as JSON here")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fixture", action="append", choices=sorted(FIXTURES), help="Only these fixtures")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = run(args.repeat, args.fixture or list(FIXTURES))
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
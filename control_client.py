@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+import typing as T
+
+import numpy as np
+
+from control_server import DEFAULT_HOST, DEFAULT_PORT
+
+
+class ControlClient:
+    # Pipelined: send() doesn't wait for earlier commands, replies are matched by id
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self._next_id = 0
+        self._waiting: T.Dict[int, "asyncio.Future[T.Dict[str, T.Any]]"] = {}
+        self._reading = asyncio.ensure_future(self._read_replies())
+
+    @classmethod
+    async def connect(cls, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> "ControlClient":
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _read_replies(self):
+        while line := await self.reader.readline():
+            reply = json.loads(line)
+            waiting = self._waiting.pop(reply.get("id"), None)
+            if waiting is not None:
+                waiting.set_result(reply)
+        for waiting in self._waiting.values():
+            waiting.set_exception(ConnectionError("Control server went away"))
+
+    def send(self, cmd: str, *args: T.Any) -> "asyncio.Future[T.Dict[str, T.Any]]":
+        self._next_id += 1
+        reply: "asyncio.Future[T.Dict[str, T.Any]]" = asyncio.get_running_loop().create_future()
+        self._waiting[self._next_id] = reply
+        self.writer.write(json.dumps({"id": self._next_id, "cmd": cmd, "args": list(args)}).encode() + b"\n")
+        return reply
+
+    async def call(self, cmd: str, *args: T.Any) -> T.Any:
+        reply = await self.send(cmd, *args)
+        if not reply["ok"]:
+            raise RuntimeError(reply["error"])
+        return reply["result"]
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self._reading.cancel()
+
+
+async def measure_round_trips(client: ControlClient, n: int, depth: int, cmd: str = "status") -> np.ndarray:
+    # Keeps `depth` commands in flight at once, returns each one's round trip
+    round_trips = np.zeros(n, dtype=np.float64)
+    sent = 0
+    in_flight: T.Set["asyncio.Future[None]"] = set()
+
+    async def one(i: int):
+        start = time.perf_counter()
+        await client.send(cmd)
+        round_trips[i] = time.perf_counter() - start
+
+    while sent < n or in_flight:
+        while sent < n and len(in_flight) < depth:
+            in_flight.add(asyncio.ensure_future(one(sent)))
+            sent += 1
+        await client.writer.drain()
+        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+    return round_trips
+
+
+async def _main(args: T.Any):
+    client = await ControlClient.connect(args.host, args.port)
+    try:
+        if args.bench:
+            round_trips = await measure_round_trips(client, args.bench, args.depth)
+            print(
+                f"{args.bench} round trips, {args.depth} in flight: "
+                f"p50 {np.median(round_trips) * 1000:.2f}ms p99 {np.percentile(round_trips, 99) * 1000:.2f}ms "
+                f"max {round_trips.max() * 1000:.2f}ms"
+            )
+        else:
+            parsed: T.List[T.Any] = []
+            for arg in args.args:
+                try:
+                    parsed.append(json.loads(arg))
+                except ValueError:
+                    parsed.append(arg)
+            print(json.dumps(await client.call(args.cmd, *parsed), indent=2))
+    finally:
+        await client.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Send commands to a running overlay's control server")
+    parser.add_argument("cmd", nargs="?", default="status", help="enqueue, queue, seek, pause, timescale, transpose, status or search")
+    parser.add_argument("args", nargs="*", help="Arguments, as JSON where they parse")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--bench", type=int, default=0, help="Measure this many status round trips instead")
+    parser.add_argument("--depth", type=int, default=16, help="Commands in flight at once while measuring")
+    args = parser.parse_args()
+    asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    main()
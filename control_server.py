@@ -0,0 +1,179 @@
+import asyncio
+import json
+import threading
+import typing as T
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 7390
+# Seconds close() waits for the server thread before giving up on it
+CLOSE_TIMEOUT = 2.0
+
+# Protocol: one JSON object per line each way.
+#   -> {"id": 1, "cmd": "seek", "args": [42.0]}
+#   <- {"id": 1, "ok": true, "result": {...}}   or   {"id": 1, "ok": false, "error": "..."}
+# Requests can be sent without waiting for replies; replies on a connection come
+# back in request order.
+
+
+def _queue(game: T.Any, name: str, clear_existing: bool = False) -> T.Any:
+    # Loads in the background, spliced in once it's ready. Unlike enqueue_file
+    # this leaves now alone, so playback carries on
+    game.queue_song(name, clear_existing=clear_existing)
+    return game.status()
+
+
+def _seek(game: T.Any, to: T.Union[float, str]) -> T.Any:
+    # A number is a song time, "+5" / "-5" is relative to now
+    if isinstance(to, str) and to[:1] in "+-":
+        game.seek(game.now + float(to))
+    else:
+        game.seek(float(to))
+    return game.status()
+
+
+def _pause(game: T.Any, paused: T.Optional[bool] = None) -> T.Any:
+    game.set_paused(not game.paused if paused is None else bool(paused))
+    return game.status()
+
+
+def _timescale(game: T.Any, timescale: float) -> T.Any:
+    game.set_timescale(float(timescale))
+    return game.status()
+
+
+def _transpose(game: T.Any, amount: int) -> T.Any:
+    game.set_transpose(int(amount))
+    return game.status()
+
+
+def _status(game: T.Any) -> T.Any:
+    return game.status()
+
+
+def _search(game: T.Any, query: str, limit: int = 10) -> T.Any:
+    return game.library.search(query, int(limit))
+
+
+COMMANDS: T.Dict[str, T.Callable[..., T.Any]] = {
+    "enqueue": _queue,
+    "queue": _queue,
+    "seek": _seek,
+    "pause": _pause,
+    "timescale": _timescale,
+    "transpose": _transpose,
+    "status": _status,
+    "search": _search,
+}
+
+
+class ControlServer:
+    # Runs an asyncio server on its own thread. Commands are handed to the render
+    # loop through game.commands and run between frames; the reply goes back once
+    # the render loop has run them, so nothing here ever waits on a frame.
+    def __init__(self, game: T.Any, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self.game = game
+        self.host = host
+        self.port = port
+        self._loop: T.Optional[asyncio.AbstractEventLoop] = None
+        self._server: T.Optional[asyncio.AbstractServer] = None
+        self._thread: T.Optional[threading.Thread] = None
+        self._started = threading.Event()
+        self._connections: T.Set["asyncio.Task[None]"] = set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="control-server", daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def close(self):
+        if self._thread is None or self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=CLOSE_TIMEOUT)
+        if self._thread.is_alive():
+            print("Control server didn't shut down in time")
+        self._thread = None
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            # Port 0 picks a free one
+            self.port = self._server.sockets[0].getsockname()[1]
+            print(f"Control server listening on {self.host}:{self.port}")
+        except OSError as e:
+            print(f"Couldn't start the control server: {e}")
+            self._started.set()
+            return
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            # wait_closed() also waits for every open connection, so end them first
+            for connection in self._connections:
+                connection.cancel()
+            self._loop.run_until_complete(asyncio.gather(*self._connections, return_exceptions=True))
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+    def _submit(self, request: T.Dict[str, T.Any]) -> "asyncio.Future[T.Dict[str, T.Any]]":
+        loop = asyncio.get_running_loop()
+        reply: "asyncio.Future[T.Dict[str, T.Any]]" = loop.create_future()
+        request_id = request.get("id", None)
+        command = COMMANDS.get(request.get("cmd", ""), None)
+        if command is None:
+            reply.set_result({"id": request_id, "ok": False, "error": f"Unknown command {request.get('cmd')!r}"})
+            return reply
+        args = request.get("args", [])
+
+        def run():
+            # On the render thread
+            try:
+                response = {"id": request_id, "ok": True, "result": command(self.game, *args)}
+            except Exception as e:
+                response = {"id": request_id, "ok": False, "error": repr(e)}
+            loop.call_soon_threadsafe(reply.set_result, response)
+
+        self.game.commands.append(run)
+        return reply
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = asyncio.current_task()
+        assert connection is not None
+        self._connections.add(connection)
+        replies: "asyncio.Queue[T.Optional[asyncio.Future[T.Dict[str, T.Any]]]]" = asyncio.Queue()
+
+        async def write_replies():
+            while (reply := await replies.get()) is not None:
+                writer.write(json.dumps(await reply).encode() + b"\n")
+                await writer.drain()
+
+        writing = asyncio.ensure_future(write_replies())
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("expected a JSON object")
+                except ValueError as e:
+                    bad: "asyncio.Future[T.Dict[str, T.Any]]" = asyncio.get_running_loop().create_future()
+                    bad.set_result({"id": None, "ok": False, "error": f"Bad request: {e}"})
+                    replies.put_nowait(bad)
+                    continue
+                replies.put_nowait(self._submit(request))
+        except asyncio.CancelledError:
+            # Shutting down: the render loop won't answer what's still pending.
+            # Not re-raised, asyncio's stream callback treats that as a crash
+            writing.cancel()
+        finally:
+            replies.put_nowait(None)
+            try:
+                await writing
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            writer.close()
+            self._connections.discard(connection)
@@ -0,0 +1,329 @@
+import heapq
+import multiprocessing
+import queue
+import time
+import typing as T
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from emission_stats import KEY, EmissionEvent, EmissionTracker
+from stroke_governor import NO_LIMITS, StrokeGovernor, chord_priorities
+
+# Both processes read the same system-wide monotonic clock
+SHARED_CLOCK = time.perf_counter
+
+RING_DTYPE = np.dtype([
+    ("when", "<f8"),      # song time the press is due
+    ("epoch", "<u4"),     # bumped on every seek, older entries are stale
+    ("pitch", "u1"),
+    ("key", "u1"),        # ord() of the key name
+    ("immediate", "u1"),  # live input, press as soon as it's read
+])
+
+# Header slots, all float64
+WRITE_IX = 0
+READ_IX = 1
+ANCHOR_WALL = 2
+ANCHOR_SONG = 3
+TIMESCALE = 4
+RUNNING = 5
+MUTED = 6
+EPOCH = 7
+CLOSED = 8
+OVERFLOWS = 9
+# Stroke limits for the emitter's governor, so they can change while it runs
+MIN_PRESS_DURATION = 10
+MAX_STROKES_PER_SEC = 11
+MIN_REPRESS_GAP = 12
+HEADER_SLOTS = 16
+
+
+class StrokeRing:
+    # Single-producer single-consumer ring of scheduled presses in shared memory,
+    # plus the song clock: song time = anchor_song + (wall - anchor_wall) * timescale
+    # while running. The renderer writes, the emitter process reads.
+    def __init__(self, shm: shared_memory.SharedMemory, capacity: int, owner: bool):
+        self.shm = shm
+        self.capacity = capacity
+        self.owner = owner
+        self.header = np.ndarray((HEADER_SLOTS,), dtype=np.float64, buffer=shm.buf)
+        self.entries = np.ndarray((capacity,), dtype=RING_DTYPE, buffer=shm.buf, offset=HEADER_SLOTS * 8)
+
+    @staticmethod
+    def size_for(capacity: int) -> int:
+        return HEADER_SLOTS * 8 + capacity * RING_DTYPE.itemsize
+
+    @classmethod
+    def create(cls, capacity: int = 4096) -> "StrokeRing":
+        shm = shared_memory.SharedMemory(create=True, size=cls.size_for(capacity))
+        ring = cls(shm, capacity, owner=True)
+        ring.header[:] = 0.0
+        ring.header[TIMESCALE] = 1.0
+        return ring
+
+    @classmethod
+    def attach(cls, name: str, capacity: int) -> "StrokeRing":
+        return cls(shared_memory.SharedMemory(name=name), capacity, owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def push(self, when: float, pitch: int, key: str, immediate: bool = False) -> bool:
+        write_ix = int(self.header[WRITE_IX])
+        if write_ix - int(self.header[READ_IX]) >= self.capacity:
+            self.header[OVERFLOWS] += 1
+            return False
+        self.entries[write_ix % self.capacity] = (when, int(self.header[EPOCH]), pitch, ord(key), immediate)
+        # Only published once the entry is in place
+        self.header[WRITE_IX] = write_ix + 1
+        return True
+
+    def pop_all(self) -> np.ndarray:
+        read_ix = int(self.header[READ_IX])
+        write_ix = int(self.header[WRITE_IX])
+        if write_ix == read_ix:
+            return self.entries[:0]
+        ixs = np.arange(read_ix, write_ix) % self.capacity
+        popped = self.entries[ixs].copy()
+        self.header[READ_IX] = write_ix
+        return popped
+
+    def publish(self, song_time: float, timescale: float, running: bool, muted: bool, wall: T.Optional[float] = None):
+        self.header[ANCHOR_WALL] = SHARED_CLOCK() if wall is None else wall
+        self.header[ANCHOR_SONG] = song_time
+        self.header[TIMESCALE] = timescale
+        self.header[RUNNING] = running
+        self.header[MUTED] = muted
+
+    def song_now(self, wall: T.Optional[float] = None) -> float:
+        if not self.header[RUNNING]:
+            return float(self.header[ANCHOR_SONG])
+        wall = SHARED_CLOCK() if wall is None else wall
+        return float(self.header[ANCHOR_SONG] + (wall - self.header[ANCHOR_WALL]) * self.header[TIMESCALE])
+
+    def due_at(self, when: float) -> float:
+        # Wall time `when` comes round, going by the current anchor
+        return float(self.header[ANCHOR_WALL] + (when - self.header[ANCHOR_SONG]) / max(self.header[TIMESCALE], 1e-9))
+
+    def set_limits(self, min_press_duration: float, max_strokes_per_sec: float, min_repress_gap: float):
+        self.header[MIN_PRESS_DURATION] = min_press_duration
+        self.header[MAX_STROKES_PER_SEC] = max_strokes_per_sec
+        self.header[MIN_REPRESS_GAP] = min_repress_gap
+
+    def limits(self) -> T.Tuple[float, float, float]:
+        return (float(self.header[MIN_PRESS_DURATION]), float(self.header[MAX_STROKES_PER_SEC]), float(self.header[MIN_REPRESS_GAP]))
+
+    @property
+    def epoch(self) -> int:
+        return int(self.header[EPOCH])
+
+    def next_epoch(self):
+        self.header[EPOCH] += 1
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.header[CLOSED])
+
+    def close(self):
+        self.header[CLOSED] = 1.0
+        # numpy views have to go before the buffer can be released
+        del self.header, self.entries
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def run_emitter(
+    ring_name: str,
+    capacity: int,
+    sender_factory: T.Callable[[], T.Any],
+    events_out: T.Any,
+    max_lateness: float = 0.1,
+    poll_interval: float = 0.001,
+):
+    # Body of the emitter process: press each key when the shared clock says so.
+    # The timings of the presses go back in batches through events_out, for the
+    # renderer's tracker, which knows which song each one came from.
+    ring = StrokeRing.attach(ring_name, capacity)
+    sender = sender_factory()
+    sender.start()
+    tracker = EmissionTracker(clock=SHARED_CLOCK)
+    governor = StrokeGovernor(sender, clock=SHARED_CLOCK, tracker=tracker)
+    # (when, sequence, pitch, key, epoch, immediate)
+    pending: T.List[T.Tuple[float, int, int, str, int, bool]] = []
+    n_late = 0
+    sequence = 0
+    last_epoch = ring.epoch
+    try:
+        while not ring.closed:
+            governor.set_limits(*ring.limits())
+            for (when, epoch, pitch, key, immediate) in ring.pop_all().tolist():
+                heapq.heappush(pending, (-float("inf") if immediate else when, sequence, pitch, chr(key), epoch, bool(immediate)))
+                sequence += 1
+            epoch = ring.epoch
+            song_now = ring.song_now()
+            running = bool(ring.header[RUNNING])
+            muted = bool(ring.header[MUTED])
+            dequeued_at = SHARED_CLOCK()
+
+            due: T.List[T.Tuple[str, int]] = []
+            while pending and (pending[0][5] or (running and pending[0][0] <= song_now)):
+                (when, _, pitch, key, entry_epoch, immediate) = heapq.heappop(pending)
+                if entry_epoch != epoch and not immediate:
+                    continue
+                if not immediate:
+                    if muted:
+                        continue
+                    if song_now - when > max_lateness:
+                        n_late += 1
+                        continue
+                    tracker.key_scheduled(key, ("", when, ring.due_at(when)))
+                due.append((key, pitch))
+            if epoch != last_epoch:
+                # Entries from before a seek might never come due, drop them all now
+                pending = [entry for entry in pending if entry[4] == epoch or entry[5]]
+                heapq.heapify(pending)
+                last_epoch = epoch
+
+            if due:
+                priorities = chord_priorities([pitch for (_, pitch) in due])
+                governor.submit([(key, prio) for ((key, _), prio) in zip(due, priorities)])
+            else:
+                governor.flush(dequeued_at)
+            if tracker.events:
+                events_out.put(tracker.events)
+                tracker.events = []
+
+            wait = poll_interval
+            if running and pending and not pending[0][5]:
+                wait = min(poll_interval, max(0.0, (pending[0][0] - song_now) / max(float(ring.header[TIMESCALE]), 1e-9)))
+            time.sleep(wait)
+    finally:
+        governor.release_all()
+        if tracker.events:
+            events_out.put(tracker.events)
+        print(governor.report())
+        if n_late:
+            print(f"Emitter: skipped {n_late} presses more than {max_lateness}s late")
+        sender.close()
+        ring.close()
+
+
+def _default_sender():
+    from interception_py.interception_sender import InterceptionSender
+    return InterceptionSender()
+
+
+class EmitterProcess:
+    # Renderer side: keeps the ring filled `lookahead` seconds of song time ahead
+    # from the key timelines, and the shared clock in step with the renderer.
+    def __init__(
+        self,
+        governor_settings: T.Dict[str, float],
+        sender_factory: T.Callable[[], T.Any] = _default_sender,
+        lookahead: float = 0.25,
+        capacity: int = 4096,
+    ):
+        self.governor_settings = governor_settings
+        self.sender_factory = sender_factory
+        self.lookahead = lookahead
+        self.capacity = capacity
+        self.ring: T.Optional[StrokeRing] = None
+        self._process: T.Optional[multiprocessing.Process] = None
+        # Batches of EmissionEvents from the emitter, song left blank
+        self._events: T.Optional["multiprocessing.Queue[T.List[EmissionEvent]]"] = None
+        # Key index -> next timeline index to schedule
+        self._cursors: T.Dict[int, int] = {}
+
+    def start(self):
+        if self._process is not None:
+            return
+        self.ring = StrokeRing.create(self.capacity)
+        self.ring.set_limits(**{**NO_LIMITS, **self.governor_settings})
+        self._events = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=run_emitter,
+            args=(self.ring.name, self.capacity, self.sender_factory, self._events),
+            name="emitter",
+            daemon=True,
+        )
+        self._process.start()
+
+    def close(self, tracker: T.Optional[EmissionTracker] = None, timeout: float = 2.0):
+        if self._process is None or self.ring is None:
+            return
+        self.ring.header[CLOSED] = 1.0
+        # Keep reading while it exits, it can't finish with its last batch unread
+        give_up_at = time.perf_counter() + timeout
+        while self._process.is_alive() and time.perf_counter() < give_up_at:
+            self.forward_events(tracker)
+            self._process.join(0.01)
+        if self._process.is_alive():
+            self._process.terminate()
+        self.forward_events(tracker)
+        self._process = None
+        self._events = None
+        if self.n_overflows:
+            print(f"Emitter: ring full {self.n_overflows} times, those presses went late")
+        self.ring.close()
+        self.ring = None
+
+    def forward_events(self, tracker: T.Optional[EmissionTracker]):
+        # Records the emitter's press timings in the renderer's tracker, tagged
+        # with the song each was scheduled from
+        if self._events is None:
+            return
+        while True:
+            try:
+                batch = self._events.get_nowait()
+            except queue.Empty:
+                return
+            if tracker is None:
+                continue
+            for event in batch:
+                tag = (tracker.song_at(event.scheduled), event.scheduled, event.due_at)
+                tracker.record(KEY, event.name, tag, event.dequeued_at, event.sent_at)
+
+    def publish(self, song_time: float, timescale: float, running: bool, muted: bool):
+        if self.ring is not None:
+            self.ring.publish(song_time, timescale, running, muted)
+
+    def set_limits(self, min_press_duration: float, max_strokes_per_sec: float, min_repress_gap: float):
+        if self.ring is not None:
+            self.ring.set_limits(min_press_duration, max_strokes_per_sec, min_repress_gap)
+
+    def reset(self):
+        # After a seek or the timelines being rebuilt: forget what was scheduled
+        self._cursors.clear()
+        if self.ring is not None:
+            self.ring.next_epoch()
+
+    def schedule(self, keys: T.List[T.Any], now: float):
+        if self.ring is None:
+            return
+        horizon = now + self.lookahead
+        for key in keys:
+            ix = max(self._cursors.get(key.ix, 0), key.when_ix)
+            n = len(key.when)
+            name = key.keyboard_key_name.lower()
+            # The toggle at when_ix flips the key's current state, like KeySquare
+            # counting n_toggles, so parity is relative to there
+            press_parity = 1 if key.should_be_down else 0
+            while ix < n and (when := key.when[ix]) <= horizon:
+                if (ix - key.when_ix) % 2 == press_parity and not self.ring.push(when, key.midi_key, name):
+                    # Ring's full: retry from this press next frame, the rest would fail too
+                    self._cursors[key.ix] = ix
+                    return
+                ix += 1
+            self._cursors[key.ix] = ix
+
+    def send_now(self, taps: T.List[T.Tuple[str, int]]):
+        if self.ring is not None:
+            for (name, pitch) in taps:
+                self.ring.push(0.0, pitch, name, immediate=True)
+
+    @property
+    def n_overflows(self) -> int:
+        return int(self.ring.header[OVERFLOWS]) if self.ring is not None else 0
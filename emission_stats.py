@@ -0,0 +1,215 @@
+import bisect
+import csv
+import json
+import math
+import os
+import threading
+import time
+import typing as T
+
+import numpy as np
+
+LATENCY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "latency")
+KEY = "key"
+MIDI = "midi"
+
+
+class LatencyHistogram:
+    # HDR-style: log-spaced buckets, so every recorded value is known to within
+    # `precision` of itself no matter how big, in constant memory. Values at or
+    # below `lowest` (including early ones) land in the first bucket.
+    def __init__(self, lowest: float = 1e-5, highest: float = 10.0, precision: float = 0.01):
+        self.lowest = lowest
+        self.highest = highest
+        self.precision = precision
+        self._log_step = math.log1p(precision)
+        n_buckets = int(math.ceil(math.log(highest / lowest) / self._log_step)) + 2
+        self.counts = np.zeros(n_buckets, dtype=np.int64)
+        self.n: int = 0
+        self.total: float = 0.0
+        self.min: float = float("inf")
+        self.max: float = -float("inf")
+
+    def _bucket(self, value: float) -> int:
+        if value <= self.lowest:
+            return 0
+        return min(len(self.counts) - 1, 1 + int(math.log(value / self.lowest) / self._log_step))
+
+    def _bucket_value(self, bucket: int) -> float:
+        # Upper edge, so percentiles err on the late side
+        if bucket == 0:
+            return self.lowest
+        return self.lowest * math.exp(bucket * self._log_step)
+
+    def record(self, value: float):
+        self.counts[self._bucket(value)] += 1
+        self.n += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        if self.n == 0:
+            return float("nan")
+        rank = max(1, int(math.ceil(q / 100.0 * self.n)))
+        bucket = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(self._bucket_value(bucket), self.max)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.n if self.n else float("nan")
+
+    def to_dict(self) -> T.Dict[str, T.Any]:
+        return {
+            "n": self.n,
+            "mean": self.mean if self.n else None,
+            "min": self.min if self.n else None,
+            "max": self.max if self.n else None,
+            "percentiles": {str(q): self.percentile(q) for q in (50, 90, 99, 99.9)} if self.n else {},
+        }
+
+
+class EmissionEvent(T.NamedTuple):
+    song: str
+    kind: str
+    name: str
+    # Song time it was scheduled for in the key's timeline
+    scheduled: float
+    # Clock times: when that song time came round, when it left the queue, and
+    # when the send (ioctl / MIDI write) returned
+    due_at: float
+    dequeued_at: float
+    sent_at: float
+
+    @property
+    def lateness(self) -> float:
+        return self.sent_at - self.due_at
+
+
+# (song, scheduled song time, due_at)
+EmissionTag = T.Tuple[str, float, float]
+
+
+class EmissionTracker:
+    # Collects the lateness of every keystroke and MIDI message against the song
+    # time it came from. Jitter is how much the lateness changed from one event to
+    # the next of the same kind.
+    def __init__(self, clock: T.Callable[[], float] = time.perf_counter, keep_events: int = 1_000_000):
+        self.clock = clock
+        self.keep_events = keep_events
+        self.events: T.List[EmissionEvent] = []
+        self.lateness: T.Dict[T.Tuple[str, str], LatencyHistogram] = {}
+        self.jitter: T.Dict[T.Tuple[str, str], LatencyHistogram] = {}
+        self._last_lateness: T.Dict[str, float] = {}
+        # Song start offsets and names, in song time
+        self._song_starts: T.List[float] = []
+        self._song_names: T.List[str] = []
+        # Key name -> tag for the press waiting on the governor
+        self._pending_keys: T.Dict[str, EmissionTag] = {}
+        self._lock = threading.Lock()
+
+    def add_song(self, name: str, offset: float):
+        ix = bisect.bisect_right(self._song_starts, offset)
+        self._song_starts.insert(ix, offset)
+        self._song_names.insert(ix, name)
+
+    def clear_songs(self):
+        self._song_starts.clear()
+        self._song_names.clear()
+        self._pending_keys.clear()
+
+    def song_at(self, when: float) -> str:
+        ix = bisect.bisect_right(self._song_starts, when) - 1
+        return self._song_names[ix] if ix >= 0 else ""
+
+    def tag(self, scheduled: float, now: float, tick_clock: float, timescale: float) -> EmissionTag:
+        # When `scheduled` came round on the clock, going by where the song was at tick_clock
+        return self.song_at(scheduled), scheduled, tick_clock - (now - scheduled) / max(timescale, 1e-9)
+
+    def key_scheduled(self, key: str, tag: EmissionTag):
+        self._pending_keys[key] = tag
+
+    def key_sent(self, key: str, dequeued_at: float, sent_at: float):
+        tag = self._pending_keys.pop(key, None)
+        if tag is not None:
+            self.record(KEY, key, tag, dequeued_at, sent_at)
+
+    def key_dropped(self, key: str):
+        # Never sent, so the next press of this key mustn't be timed against it
+        self._pending_keys.pop(key, None)
+
+    def record(self, kind: str, name: str, tag: EmissionTag, dequeued_at: float, sent_at: float):
+        song, scheduled, due_at = tag
+        event = EmissionEvent(song, kind, name, scheduled, due_at, dequeued_at, sent_at)
+        lateness = event.lateness
+        with self._lock:
+            if len(self.events) < self.keep_events:
+                self.events.append(event)
+            if (song, kind) not in self.lateness:
+                self.lateness[(song, kind)] = LatencyHistogram()
+                self.jitter[(song, kind)] = LatencyHistogram()
+            self.lateness[(song, kind)].record(lateness)
+            last = self._last_lateness.get(kind, None)
+            if last is not None:
+                self.jitter[(song, kind)].record(abs(lateness - last))
+            self._last_lateness[kind] = lateness
+
+    def readout(self, song: T.Optional[str] = None) -> str:
+        # One line for the overlay
+        parts: T.List[str] = []
+        with self._lock:
+            for kind in (KEY, MIDI):
+                key = (song, kind) if song is not None else None
+                late = self.lateness.get(key) if key is not None else None
+                if late is None:
+                    # Latest song with anything of this kind
+                    matching = [k for k in self.lateness if k[1] == kind]
+                    if not matching:
+                        continue
+                    key = matching[-1]
+                    late = self.lateness[key]
+                jitter = self.jitter[key]
+                parts.append(
+                    f"{kind} late p50 {late.percentile(50) * 1000:.1f} p99 {late.percentile(99) * 1000:.1f} "
+                    f"jitter p99 {jitter.percentile(99) * 1000:.1f}ms"
+                )
+        return " | ".join(parts)
+
+    def summary(self) -> T.Dict[str, T.Any]:
+        with self._lock:
+            return {
+                f"{song}/{kind}": {
+                    "lateness": self.lateness[(song, kind)].to_dict(),
+                    "jitter": self.jitter[(song, kind)].to_dict(),
+                }
+                for (song, kind) in self.lateness
+            }
+
+    def report(self) -> str:
+        lines = ["Emission lateness (ms):"]
+        for name, stats in self.summary().items():
+            late = stats["lateness"]
+            percentiles = late["percentiles"]
+            lines.append(
+                f"  {name}: {late['n']} events, p50 {percentiles['50'] * 1000:.2f} "
+                f"p99 {percentiles['99'] * 1000:.2f} max {late['max'] * 1000:.2f}"
+            )
+        return "\n".join(lines)
+
+    def export(self, fname_base: T.Optional[str] = None) -> T.Optional[str]:
+        # Writes <base>.csv with every event and <base>.json with the histograms
+        if not self.events:
+            return None
+        if fname_base is None:
+            os.makedirs(LATENCY, exist_ok=True)
+            fname_base = os.path.join(LATENCY, time.strftime("emission_%Y%m%d_%H%M%S"))
+        with self._lock:
+            events = list(self.events)
+        with open(fname_base + ".csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(EmissionEvent._fields + ("lateness",))
+            for event in events:
+                writer.writerow(event + (event.lateness,))
+        with open(fname_base + ".json", "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        return fname_base
@@ -0,0 +1,296 @@
+import multiprocessing
+import queue
+import time
+import typing as T
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from emission_process import SHARED_CLOCK
+from stroke_governor import StrokeGovernor, chord_priorities
+
+PARTITIONS = ("range", "voice")
+# Seconds between every player being ready and the first note
+START_LEAD = 1.0
+# How often the parent checks for players that died without reporting
+POLL_INTERVAL = 0.5
+
+
+class NullSender:
+    # Presses nothing, for timing the ensemble without a game
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def keyDown(self, key: str):
+        pass
+
+    def keyUp(self, key: str):
+        pass
+
+
+def null_sender(player: int) -> NullSender:
+    return NullSender()
+
+
+def interception_sender(player: int) -> T.Any:
+    # Each player calibrates on whichever keyboard is pressed first, so press a
+    # key on each game client's keyboard in turn
+    from interception_py.interception_sender import InterceptionSender
+    return InterceptionSender()
+
+
+def song_presses(pitches: np.ndarray, whens: np.ndarray, transpose: int) -> T.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # The onsets of a song as (source pitch, when, key index into the layout),
+    # dropping the ones that fold onto a black key
+    from read_notes import toggle_occurrence
+    from render_notes import fold_into_range, keyboard_names_by_pitch
+
+    is_onset = toggle_occurrence(pitches) % 2 == 0
+    pitches, whens = pitches[is_onset], whens[is_onset]
+    names = keyboard_names_by_pitch()
+    key_ix = np.array([-1 if name is None else ord(name.lower()) for name in names], dtype=np.int64)[fold_into_range(pitches + transpose)]
+    playable = key_ix >= 0
+    return pitches[playable], whens[playable], key_ix[playable]
+
+
+def partition_by_range(pitches: np.ndarray, n_players: int) -> np.ndarray:
+    # Contiguous pitch ranges, split so each player gets about as many notes
+    if len(pitches) == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.sort(pitches)
+    bounds = order[np.minimum((np.arange(1, n_players) * len(order)) // n_players, len(order) - 1)]
+    return np.searchsorted(bounds, pitches, side="right")
+
+
+def partition_by_voice(pitches: np.ndarray, whens: np.ndarray, n_players: int) -> np.ndarray:
+    # Within each chord the top note goes to player 0, the next down to player 1
+    # and so on, with the last player taking everything below
+    order = np.lexsort((-pitches, whens))
+    sorted_whens = whens[order]
+    chord_start = np.diff(sorted_whens, prepend=-np.inf) != 0
+    start_ix = np.maximum.accumulate(np.where(chord_start, np.arange(len(order)), 0))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - start_ix
+    return np.minimum(rank, n_players - 1)
+
+
+def run_player(
+    player: int,
+    whens: np.ndarray,
+    keys: np.ndarray,
+    pitches: np.ndarray,
+    sender_factory: T.Callable[[int], T.Any],
+    governor_settings: T.Dict[str, float],
+    start_at: T.Any,
+    go: T.Any,
+    results: T.Any,
+    spin: float = 0.002,
+):
+    # Body of one player process. Any failure is reported back, so the parent
+    # doesn't wait forever on a player that's gone
+    try:
+        _play(player, whens, keys, pitches, sender_factory, governor_settings, start_at, go, results, spin)
+    except Exception as e:
+        results.put(("error", player, repr(e)))
+        raise
+
+
+def _play(
+    player: int,
+    whens: np.ndarray,
+    keys: np.ndarray,
+    pitches: np.ndarray,
+    sender_factory: T.Callable[[int], T.Any],
+    governor_settings: T.Dict[str, float],
+    start_at: T.Any,
+    go: T.Any,
+    results: T.Any,
+    spin: float,
+):
+    # Sleeps until just before each onset, then spins the rest of the way for accuracy
+    sender = sender_factory(player)
+    sender.start()
+    governor = StrokeGovernor(sender, clock=SHARED_CLOCK, **governor_settings)
+    results.put(("ready", player, None))
+    go.wait()
+    start = start_at.value
+
+    onsets, first = np.unique(whens, return_index=True)
+    bounds = np.r_[first, len(whens)]
+    sent = np.zeros(len(onsets), dtype=np.float64)
+    try:
+        for i, onset in enumerate(onsets.tolist()):
+            due = start + onset
+            while (left := due - SHARED_CLOCK()) > spin:
+                governor.flush()
+                time.sleep(min(left - spin, 0.005))
+            while SHARED_CLOCK() < due:
+                pass
+            chord = slice(bounds[i], bounds[i + 1])
+            priorities = chord_priorities(pitches[chord].tolist())
+            governor.submit([(chr(k), prio) for (k, prio) in zip(keys[chord].tolist(), priorities)])
+            sent[i] = SHARED_CLOCK()
+        time.sleep(governor.min_press_duration)
+        governor.flush()
+    finally:
+        governor.release_all()
+        sender.close()
+    results.put(("done", player, (onsets, sent - start, governor.n_sent, governor.n_dropped)))
+
+
+def _next_result(results: T.Any, processes: T.List[T.Any]) -> T.Tuple[str, int, T.Any]:
+    while True:
+        try:
+            kind, player, payload = results.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            for process in processes:
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError(f"{process.name} exited with code {process.exitcode}")
+            continue
+        if kind == "error":
+            raise RuntimeError(f"player {player} failed: {payload}")
+        return kind, player, payload
+
+
+@dataclass
+class PlayerTiming:
+    player: int
+    onsets: np.ndarray
+    # Relative to the shared start, like onsets
+    sent: np.ndarray
+    n_sent: int
+    n_dropped: int
+
+    @property
+    def lateness(self) -> np.ndarray:
+        return self.sent - self.onsets
+
+
+@dataclass
+class EnsembleReport:
+    players: T.List[PlayerTiming] = field(default_factory=list)
+
+    def chord_spread(self) -> np.ndarray:
+        # For onsets more than one player plays, how far apart their presses landed
+        all_onsets = np.concatenate([p.onsets for p in self.players]) if self.players else np.zeros(0)
+        all_sent = np.concatenate([p.sent for p in self.players]) if self.players else np.zeros(0)
+        if len(all_onsets) == 0:
+            return np.zeros(0)
+        order = np.argsort(all_onsets, kind="stable")
+        onsets, sent = all_onsets[order], all_sent[order]
+        starts = np.flatnonzero(np.diff(onsets, prepend=-np.inf) != 0)
+        shared = np.diff(np.r_[starts, len(onsets)]) > 1
+        spread = np.maximum.reduceat(sent, starts) - np.minimum.reduceat(sent, starts)
+        return spread[shared]
+
+    def summary(self) -> str:
+        lines = []
+        medians = [float(np.median(p.lateness)) if len(p.lateness) else 0.0 for p in self.players]
+        reference = float(np.median(medians)) if medians else 0.0
+        for p, median in zip(self.players, medians):
+            late = p.lateness
+            if len(late) == 0:
+                lines.append(f"player {p.player}: no notes")
+                continue
+            lines.append(
+                f"player {p.player}: {len(late)} onsets, {p.n_sent} strokes, {p.n_dropped} dropped, "
+                f"late ms p50 {median * 1000:.2f} p99 {np.percentile(late, 99) * 1000:.2f} max {late.max() * 1000:.2f}, "
+                f"skew vs ensemble {(median - reference) * 1000:+.2f}ms"
+            )
+        spread = self.chord_spread()
+        if len(spread):
+            lines.append(
+                f"shared onsets: {len(spread)}, spread ms p50 {np.median(spread) * 1000:.2f} "
+                f"p99 {np.percentile(spread, 99) * 1000:.2f} max {spread.max() * 1000:.2f}"
+            )
+        return "\n".join(lines)
+
+
+def play_ensemble(
+    fname: str,
+    n_players: int,
+    partition: str = "range",
+    sender_factory: T.Callable[[int], T.Any] = interception_sender,
+    governor_settings: T.Optional[T.Dict[str, float]] = None,
+    timescale: float = 1.0,
+) -> EnsembleReport:
+    from read_notes import load_song
+
+    song = load_song(fname)
+    pitches, whens, keys = song_presses(*song.to_arrays(), song.transpose)
+    whens = whens / timescale
+    if partition == "range":
+        parts = partition_by_range(pitches, n_players)
+    elif partition == "voice":
+        parts = partition_by_voice(pitches, whens, n_players)
+    else:
+        raise ValueError(f"Unknown partition {partition}, expected one of {PARTITIONS}")
+
+    ctx = multiprocessing.get_context("spawn")
+    start_at = ctx.Value("d", 0.0)
+    go = ctx.Event()
+    results = ctx.Queue()
+    processes = []
+    for player in range(n_players):
+        mine = parts == player
+        processes.append(ctx.Process(
+            target=run_player,
+            args=(player, whens[mine], keys[mine], pitches[mine], sender_factory, governor_settings or {}, start_at, go, results),
+            name=f"player-{player}",
+            daemon=True,
+        ))
+        print(f"player {player}: {int(mine.sum())} notes" + (f", pitches {pitches[mine].min()}-{pitches[mine].max()}" if mine.any() else ""))
+    for process in processes:
+        process.start()
+
+    report = EnsembleReport()
+    try:
+        n_ready = 0
+        while n_ready < n_players:
+            kind, _, _ = _next_result(results, processes)
+            n_ready += kind == "ready"
+        # Everyone counts from the same instant on the shared monotonic clock
+        start_at.value = SHARED_CLOCK() + START_LEAD
+        go.set()
+
+        while len(report.players) < n_players:
+            kind, player, payload = _next_result(results, processes)
+            if kind == "done":
+                onsets, sent, n_sent, n_dropped = payload
+                report.players.append(PlayerTiming(player, onsets, sent, n_sent, n_dropped))
+    except BaseException:
+        # One player down means the rest are playing a broken ensemble
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        raise
+    for process in processes:
+        process.join()
+    report.players.sort(key=lambda p: p.player)
+    return report
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Split a song across several players, each with its own keyboard output")
+    parser.add_argument("song", help="Path to a .mid / .mscz / .gmsong file")
+    parser.add_argument("--players", type=int, default=2)
+    parser.add_argument("--by", choices=PARTITIONS, default="range")
+    parser.add_argument("--timescale", type=float, default=1.0)
+    parser.add_argument("--dry-run", action="store_true", help="Time everything but press no keys")
+    args = parser.parse_args()
+    report = play_ensemble(
+        args.song,
+        args.players,
+        args.by,
+        null_sender if args.dry_run else interception_sender,
+        timescale=args.timescale,
+    )
+    print(report.summary())
+
+
+if __name__ == "__main__":
+    main()
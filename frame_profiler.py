@@ -0,0 +1,92 @@
+import os
+import time
+import typing as T
+
+import numpy as np
+
+if T.TYPE_CHECKING:
+    import cProfile
+
+PROFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+PHASES = ("events", "midi_in", "songs", "keys", "emit", "draw", "flip", "sleep")
+
+
+class FrameProfiler:
+    # Splits each frame into phases with one clock read per phase boundary, and
+    # keeps the last `window` frames for a rolling breakdown. mark(phase) charges
+    # everything since the previous mark to that phase.
+    def __init__(self, window: int = 120, clock: T.Callable[[], float] = time.perf_counter):
+        self.window = window
+        self.clock = clock
+        self._phase_ix = {phase: i for i, phase in enumerate(PHASES)}
+        self.frames = np.zeros((window, len(PHASES)), dtype=np.float64)
+        self.n_frames: int = 0
+        self._current = [0.0] * len(PHASES)
+        self._last: T.Optional[float] = None
+        self._profile: T.Optional["cProfile.Profile"] = None
+
+    def begin_frame(self):
+        self._current = [0.0] * len(PHASES)
+        self._last = self.clock()
+
+    def mark(self, phase: str):
+        if self._last is None:
+            return
+        now = self.clock()
+        self._current[self._phase_ix[phase]] += now - self._last
+        self._last = now
+
+    def end_frame(self):
+        if self._last is None:
+            return
+        self.frames[self.n_frames % self.window] = self._current
+        self.n_frames += 1
+        self._last = None
+
+    def recent(self) -> np.ndarray:
+        return self.frames[:min(self.n_frames, self.window)]
+
+    def breakdown(self) -> T.Dict[str, T.Tuple[float, float]]:
+        # Phase -> (mean, max) seconds over the window
+        recent = self.recent()
+        if len(recent) == 0:
+            return {}
+        return {phase: (float(recent[:, i].mean()), float(recent[:, i].max())) for i, phase in enumerate(PHASES)}
+
+    def lines(self) -> T.List[str]:
+        recent = self.recent()
+        if len(recent) == 0:
+            return []
+        totals = recent.sum(axis=1)
+        lines = [f"frame {totals.mean() * 1000:.2f}ms mean, {totals.max() * 1000:.2f}ms max over {len(recent)}"]
+        for phase, (mean, worst) in self.breakdown().items():
+            lines.append(f"{phase:>8} {mean * 1000:6.2f} {worst * 1000:6.2f}")
+        return lines
+
+    @property
+    def is_capturing(self) -> bool:
+        return self._profile is not None
+
+    def start_capture(self):
+        if self._profile is None:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop_capture(self, fname: T.Optional[str] = None) -> T.Optional[str]:
+        if self._profile is None:
+            return None
+        self._profile.disable()
+        if fname is None:
+            os.makedirs(PROFILES, exist_ok=True)
+            fname = os.path.join(PROFILES, time.strftime("frames_%Y%m%d_%H%M%S.prof"))
+        self._profile.dump_stats(fname)
+        self._profile = None
+        return fname
+
+    def toggle_capture(self) -> T.Optional[str]:
+        # Returns the file written when a capture stops
+        if self.is_capturing:
+            return self.stop_capture()
+        self.start_capture()
+        return None
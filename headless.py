@@ -0,0 +1,126 @@
+import os
+import typing as T
+
+# Must be set before pygame opens a window
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+from render_notes import GameSettings, MIDIRenderer
+
+DEFAULT_SIZE = (800, 480)
+TAIL_SECONDS = 1.0
+
+
+class VirtualClock:
+    # Stands in for time.time(), but only moves when told to
+    def __init__(self, start: float = 0.0):
+        self.t = start
+
+    def __call__(self) -> float:
+        return self.t
+
+    def advance(self, seconds: float):
+        self.t += seconds
+
+
+def headless_settings(**overrides: T.Any) -> GameSettings:
+    settings: T.Dict[str, T.Any] = dict(
+        macro_output=False,
+        play_sounds=False,
+        paused=False,
+    )
+    settings.update(overrides)
+    return GameSettings(**settings)
+
+
+def make_headless_renderer(
+    size: T.Tuple[int, int] = DEFAULT_SIZE,
+    preset: T.Optional[GameSettings] = None,
+    clock: T.Optional[VirtualClock] = None,
+) -> T.Tuple[MIDIRenderer, VirtualClock]:
+    pygame.init()
+    pygame.display.set_mode(size)
+    clock = clock or VirtualClock()
+    return MIDIRenderer(preset or headless_settings(), clock=clock), clock
+
+
+def enqueue_song(game: MIDIRenderer, song: str):
+    # Either a library name or a path to a file
+    if os.path.exists(song):
+        name = os.path.splitext(os.path.basename(song))[0].lower()
+        game.add_library_file(name, song)
+        song = name
+    game.enqueue_file(song)
+
+
+def render_frames(
+    game: MIDIRenderer,
+    clock: VirtualClock,
+    fps: float = 60.0,
+    duration: T.Optional[float] = None,
+) -> T.Iterator[pygame.Surface]:
+    # Steps the renderer in virtual time, as fast as it can draw. The surface
+    # yielded is the display itself, copy it to keep it.
+    if duration is None:
+        duration = game.enqueue_at + TAIL_SECONDS
+    frame_time = 1.0 / fps
+    game.update()
+    while game.now < duration and not game.is_done:
+        clock.advance(frame_time)
+        game.update()
+        game.draw()
+        yield pygame.display.get_surface()
+
+
+def render_song(
+    song: str,
+    output: T.Optional[str] = None,
+    fmt: str = "png",
+    fps: float = 60.0,
+    duration: T.Optional[float] = None,
+    size: T.Tuple[int, int] = DEFAULT_SIZE,
+    preset: T.Optional[GameSettings] = None,
+) -> T.Union[T.List[pygame.Surface], int]:
+    # output=None returns the frames as surfaces. Otherwise fmt "png" writes
+    # output/frame_000000.png..., and "raw" appends RGB24 frames to the file output.
+    game, clock = make_headless_renderer(size, preset)
+    enqueue_song(game, song)
+    frames = render_frames(game, clock, fps, duration)
+    if output is None:
+        return [frame.copy() for frame in frames]
+
+    n_frames = 0
+    if fmt == "png":
+        os.makedirs(output, exist_ok=True)
+        for frame in frames:
+            pygame.image.save(frame, os.path.join(output, f"frame_{n_frames:06d}.png"))
+            n_frames += 1
+    elif fmt == "raw":
+        with open(output, "wb") as f:
+            for frame in frames:
+                f.write(pygame.image.tobytes(frame, "RGB"))
+                n_frames += 1
+    else:
+        raise ValueError(f"Unknown frame format {fmt}")
+    return n_frames
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Render a song's overlay without a window")
+    parser.add_argument("song", help="Library name or path to a .mid / .mscz / .gmsong file")
+    parser.add_argument("output", help="Directory for PNG frames, or file for raw RGB24 frames")
+    parser.add_argument("--format", choices=["png", "raw"], default="png")
+    parser.add_argument("--fps", type=float, default=60.0)
+    parser.add_argument("--duration", type=float, default=None)
+    parser.add_argument("--width", type=int, default=DEFAULT_SIZE[0])
+    parser.add_argument("--height", type=int, default=DEFAULT_SIZE[1])
+    args = parser.parse_args()
+    n_frames = render_song(args.song, args.output, args.format, args.fps, args.duration, (args.width, args.height))
+    print(f"Wrote {n_frames} frames")
+
+
+if __name__ == "__main__":
+    main()
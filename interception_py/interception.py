@@ -6,7 +6,11 @@ MAX_DEVICES = 20
 MAX_KEYBOARD = 10
 MAX_MOUSE  = 10
 
-k32 = windll.LoadLibrary('kernel32')
+try:
+    k32 = windll.LoadLibrary('kernel32')
+except NameError:
+    # Not on Windows. Importable anyway, so a stand-in can be swapped in
+    k32 = None
 
 class interception():
     _context = []
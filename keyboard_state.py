@@ -0,0 +1,34 @@
+import typing as T
+
+import numpy as np
+
+
+class KeyboardState:
+    # One row per key. KeySquare reads and writes its own row; the renderer asks
+    # questions about every key at once.
+    def __init__(self, n_keys: int):
+        self.n_keys = n_keys
+        self.should_be_down = np.zeros(n_keys, dtype=bool)
+        self.is_really_down = np.zeros(n_keys, dtype=bool)
+        self.key_is_pressed = np.zeros(n_keys, dtype=bool)
+        self.note_on = np.zeros(n_keys, dtype=bool)
+        self.when_ix = np.zeros(n_keys, dtype=np.int64)
+        # Mirrors of each key's timeline, so we don't have to visit them
+        self.n_when = np.zeros(n_keys, dtype=np.int64)
+        self.next_when = np.full(n_keys, np.inf, dtype=np.float64)
+
+    def okay_to_progress(self) -> bool:
+        # It's okay to leave things on, but not to have them off
+        return bool(np.all(~self.should_be_down | self.is_really_down))
+
+    def any_reviewing(self) -> bool:
+        return bool(np.any(self.when_ix != self.n_when))
+
+    def due(self, now: float) -> np.ndarray:
+        return np.flatnonzero(self.next_when <= now)
+
+    def sync_timeline(self, ix: int, when: T.Sequence[float]):
+        n = len(when)
+        self.n_when[ix] = n
+        w_ix = self.when_ix[ix]
+        self.next_when[ix] = when[w_ix] if w_ix < n else np.inf
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+import typing as T
+from collections import deque
+
+from read_notes import COMPILED_EXT, LIBRARY_SOURCES, SONG_EXTS, LibraryIndex, invalidate_song_cache
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+
+# (kind, absolute path)
+LibraryChange = T.Tuple[str, str]
+# path -> (mtime_ns, size)
+Snapshot = T.Dict[str, T.Tuple[int, int]]
+
+
+def snapshot_directory(each_dir: str) -> Snapshot:
+    found: Snapshot = {}
+    try:
+        entries = list(os.scandir(each_dir))
+    except OSError:
+        return found
+    for entry in entries:
+        if os.path.splitext(entry.name)[1].lower() not in SONG_EXTS:
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        found[os.path.abspath(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+    return found
+
+
+def diff_snapshots(before: Snapshot, after: Snapshot) -> T.List[LibraryChange]:
+    changes: T.List[LibraryChange] = []
+    for path, stamp in after.items():
+        old = before.get(path, None)
+        if old is None:
+            changes.append((ADDED, path))
+        elif old != stamp:
+            changes.append((MODIFIED, path))
+    for path in before:
+        if path not in after:
+            changes.append((REMOVED, path))
+    return changes
+
+
+class LibraryWatcher:
+    # Polls the library directories for song files that appeared, vanished or
+    # changed. Stat-ing happens on a background thread, the first snapshot
+    # included; the changes wait in a deque until the render loop drains them
+    # with apply(), so the index is only ever touched from one thread.
+    def __init__(self, sources: T.Optional[T.List[str]] = None, interval: float = 1.0):
+        self.sources = [os.path.abspath(d) for d in (LIBRARY_SOURCES if sources is None else sources)]
+        self.interval = interval
+        self.changes: T.Deque[LibraryChange] = deque()
+        # Taken by the first poll(), which reports nothing
+        self._snapshots: T.Optional[T.Dict[str, Snapshot]] = None
+        self._running = False
+        self._thread: T.Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="library-watcher", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def poll(self) -> T.List[LibraryChange]:
+        if self._snapshots is None:
+            self._snapshots = {d: snapshot_directory(d) for d in self.sources}
+            return []
+        found: T.List[LibraryChange] = []
+        for each_dir in self.sources:
+            after = snapshot_directory(each_dir)
+            found.extend(diff_snapshots(self._snapshots[each_dir], after))
+            self._snapshots[each_dir] = after
+        return found
+
+    def _run(self):
+        while self._running:
+            self.changes.extend(self.poll())
+            # Sleep in small steps so close() doesn't wait a whole interval
+            deadline = time.perf_counter() + self.interval
+            while self._running and time.perf_counter() < deadline:
+                time.sleep(min(0.05, self.interval))
+
+    def drain(self) -> T.List[LibraryChange]:
+        drained: T.List[LibraryChange] = []
+        while True:
+            try:
+                drained.append(self.changes.popleft())
+            except IndexError:
+                break
+        return drained
+
+    def apply(self, index: T.Optional[LibraryIndex]) -> T.List[LibraryChange]:
+        # Brings the index and the parsed-song cache up to date, returns what
+        # changed. Without an index yet there's nothing to update: whenever it's
+        # scanned, it sees the files as they are by then.
+        changes = self.drain()
+        for (kind, path) in changes:
+            invalidate_song_cache(path)
+            if index is None:
+                continue
+            if kind == ADDED:
+                index.add(os.path.splitext(os.path.basename(path))[0], path)
+            elif kind == REMOVED:
+                index.remove(path)
+            elif kind == MODIFIED and os.path.splitext(path)[1].lower() != COMPILED_EXT:
+                # A compiled copy would now shadow the edit
+                name = os.path.splitext(os.path.basename(path))[0]
+                for stale in index.candidates(name):
+                    if os.path.splitext(stale)[1].lower() == COMPILED_EXT:
+                        print(f"Ignoring {stale}, its source changed")
+                        index.remove(stale)
+        return changes
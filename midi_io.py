@@ -0,0 +1,184 @@
+import queue
+import threading
+import time
+import typing as T
+from collections import deque
+
+import pygame.midi
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+STATUS_MASK = 0xF0
+
+# (timestamp_ms, pitch, is_on)
+NoteEvent = T.Tuple[int, int, bool]
+
+
+def decode_note_event(status: int, data1: int, data2: int) -> T.Optional[T.Tuple[int, bool]]:
+    # Any channel. A note_on with velocity 0 is a note_off
+    kind = status & STATUS_MASK
+    if kind == NOTE_ON:
+        return data1, data2 > 0
+    elif kind == NOTE_OFF:
+        return data1, False
+    else:
+        return None
+
+
+class MIDIInputReader:
+    def __init__(self, device: pygame.midi.Input, poll_interval: float = 0.001, batch_size: int = 1024):
+        self.device = device
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        # deque.append / popleft are atomic, so no lock between reader and render thread
+        self.events: T.Deque[NoteEvent] = deque()
+        self._running = False
+        self._thread: T.Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="midi-input", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _read_all(self) -> T.List[NoteEvent]:
+        found: T.List[NoteEvent] = []
+        while self.device.poll():
+            for ((status, data1, data2, _), timestamp) in self.device.read(self.batch_size):
+                decoded = decode_note_event(status, data1, data2)
+                if decoded is not None:
+                    pitch, is_on = decoded
+                    found.append((timestamp, pitch, is_on))
+        # Stable, so events with the same timestamp keep their arrival order
+        found.sort(key=lambda ev: ev[0])
+        return found
+
+    def _run(self):
+        while self._running:
+            batch = self._read_all()
+            if batch:
+                self.events.extend(batch)
+            else:
+                time.sleep(self.poll_interval)
+
+    def drain(self) -> T.List[NoteEvent]:
+        drained: T.List[NoteEvent] = []
+        while True:
+            try:
+                drained.append(self.events.popleft())
+            except IndexError:
+                break
+        return drained
+
+
+# (timestamp_ms, status, data1, data2, enqueued_at, emission tag)
+QueuedMessage = T.Tuple[int, int, int, int, float, T.Any]
+
+
+class MIDIOutputWorker:
+    def __init__(self, device: T.Optional[pygame.midi.Output], max_batch: int = 1024, tracker: T.Any = None):
+        self.device = device
+        self.max_batch = max_batch
+        # EmissionTracker, told about every tagged message once it's written
+        self.tracker = tracker
+        self._queue: "queue.Queue[T.Optional[QueuedMessage]]" = queue.Queue()
+        self._thread: T.Optional[threading.Thread] = None
+
+        # Stats
+        self.n_sent: int = 0
+        self.n_batches: int = 0
+        self.last_latency: float = 0.0
+        self.max_latency: float = 0.0
+        self._total_latency: float = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="midi-output", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def send(self, status: int, data1: int, data2: int, tag: T.Any = None):
+        # pygame.midi's clock only runs once a port has been opened
+        timestamp = pygame.midi.time() if self.device is not None else int(time.perf_counter() * 1000)
+        self._queue.put((timestamp, status, data1, data2, time.perf_counter(), tag))
+
+    def note_on(self, note: int, velocity: int = 127, channel: int = 0, tag: T.Any = None):
+        self.send(NOTE_ON | channel, note, velocity, tag)
+
+    def note_off(self, note: int, velocity: int = 127, channel: int = 0, tag: T.Any = None):
+        self.send(NOTE_OFF | channel, note, velocity, tag)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def mean_latency(self) -> float:
+        return self._total_latency / self.n_sent if self.n_sent else 0.0
+
+    def _take_pending(self) -> T.Tuple[T.List[QueuedMessage], bool]:
+        # Block for one message, then grab whatever else is already waiting
+        first = self._queue.get()
+        if first is None:
+            return [], False
+        pending = [first]
+        while True:
+            try:
+                msg = self._queue.get_nowait()
+            except queue.Empty:
+                return pending, True
+            if msg is None:
+                return pending, False
+            pending.append(msg)
+
+    def _write(self, batch: T.List[QueuedMessage]):
+        dequeued_at = self.tracker.clock() if self.tracker is not None else 0.0
+        if self.device is not None:
+            self.device.write([[[status, data1, data2], timestamp] for (timestamp, status, data1, data2, _, _) in batch])
+        if self.tracker is not None:
+            tracked_at = self.tracker.clock()
+            for (_, _, data1, _, _, tag) in batch:
+                if tag is not None:
+                    self.tracker.record("midi", str(data1), tag, dequeued_at, tracked_at)
+        sent_at = time.perf_counter()
+        for (_, _, _, _, enqueued_at, _) in batch:
+            latency = sent_at - enqueued_at
+            self._total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.last_latency = latency
+        self.n_sent += len(batch)
+        self.n_batches += 1
+
+    def _run(self):
+        running = True
+        while running:
+            pending, running = self._take_pending()
+            # Everything due in the same millisecond goes out in one write
+            batch: T.List[QueuedMessage] = []
+            for msg in pending:
+                if batch and (msg[0] != batch[0][0] or len(batch) >= self.max_batch):
+                    self._write(batch)
+                    batch = []
+                batch.append(msg)
+            if batch:
+                self._write(batch)
+
+    def report(self) -> str:
+        return (
+            f"MIDI out: {self.n_sent} messages in {self.n_batches} batches, "
+            f"queue depth {self.queue_depth}, "
+            f"latency mean {self.mean_latency * 1000:.2f}ms / max {self.max_latency * 1000:.2f}ms"
+        )
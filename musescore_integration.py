@@ -9,7 +9,8 @@ def convert(mscz_file: str) -> str:
     name, ext = os.path.splitext(base)
     assert ext == ".mscz", "Not a musescore file"
     output_file = os.path.join(conversion_dir, f"{name}.mid")
-    if not os.path.exists(output_file):
+    # Reconvert when the score was edited after the last conversion
+    if not os.path.exists(output_file) or os.path.getmtime(mscz_file) > os.path.getmtime(output_file):
         proc = subprocess.run(
             [
                 MUSE,
@@ -0,0 +1,69 @@
+import os
+import typing as T
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+from read_notes import COMPILED_EXT, CompiledSong, load_song
+
+
+class QueuedSong(T.NamedTuple):
+    name: str
+    fname: str
+    min_confidence: float
+    chord_tolerance: float
+    future: "Future[CompiledSong]"
+
+
+class Playlist:
+    # Songs are prepared off the render thread (parsing, MuseScore conversion and
+    # autotranspose run in a worker process), but come out in the order they were
+    # queued.
+    def __init__(self, executor: T.Optional[Executor] = None):
+        self._executor = executor
+        self._queue: T.Deque[QueuedSong] = deque()
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=1)
+        return self._executor
+
+    def load(self, fname: str, chord_tolerance: float = 0.0) -> "Future[CompiledSong]":
+        # Outside the queue, for callers that collect the result themselves
+        future: "Future[CompiledSong]"
+        if os.path.splitext(fname)[1].lower() == COMPILED_EXT:
+            # Memory-mapped, no reason to ship it to another process
+            future = Future()
+            try:
+                future.set_result(load_song(fname, chord_tolerance))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self._get_executor().submit(load_song, fname, chord_tolerance)
+        return future
+
+    def submit(self, name: str, fname: str, min_confidence: float = 0, chord_tolerance: float = 0.0):
+        future = self.load(fname, chord_tolerance)
+        self._queue.append(QueuedSong(name, fname, min_confidence, chord_tolerance, future))
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def pop_ready(self) -> T.Iterator[T.Tuple[QueuedSong, T.Optional[CompiledSong]]]:
+        # Never blocks; stops at the first song that isn't ready yet
+        while self._queue and self._queue[0].future.done():
+            queued = self._queue.popleft()
+            try:
+                yield queued, queued.future.result()
+            except Exception as e:
+                print(f"Couldn't load {queued.name}: {e!r}")
+                yield queued, None
+
+    def clear(self):
+        while self._queue:
+            self._queue.popleft().future.cancel()
+
+    def close(self):
+        self.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
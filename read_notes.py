@@ -1,30 +1,160 @@
-import mido
-from mido.midifiles.midifiles import DEFAULT_TICKS_PER_BEAT, DEFAULT_TEMPO
-mido.set_backend('mido.backends.rtmidi_python')
-
-from musescore_integration import convert
-
+import bisect
+import json
+import mmap
 import os
+import re
+import struct
 import typing as T
 
+import numpy as np
+
 RECORDINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings")
+COMPILED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compiled")
+COMPILED_EXT = ".gmsong"
+RECORDING_NAME = re.compile(r"^recording_(\d+)$")
+NOTE_ON_STATUS = 0x90
+NOTE_OFF_STATUS = 0x80
+MAX_VARIABLE_INT = 0x0FFFFFFF
+_next_recording_id: T.Optional[int] = None
 
-def read_midi_file(fname: str) -> T.List[T.Tuple[int, float]]:
+# Compiled song layout, all little-endian:
+#   header (SONG_HEADER, padded to SONG_HEADER_SIZE)
+#   offsets    uint64[N_MIDI_PITCHES + 1]   where each pitch's run starts in times
+#   times      float64[n_events]            grouped by pitch, sorted within each
+#   metadata   utf-8 JSON
+SONG_MAGIC = b"GMSONG\x00\x00"
+SONG_VERSION = 2
+SONG_HEADER = struct.Struct("<8sIIidIQ")
+SONG_HEADER_SIZE = 64
+N_MIDI_PITCHES = 128
+# Same as mido's, which isn't imported until a file is actually parsed
+DEFAULT_TICKS_PER_BEAT = 480
+DEFAULT_TEMPO = 500000
+_mido: T.Any = None
+
+class TempoMap:
+    # Piecewise-constant tempo: tempos[i] (microseconds per beat) holds from
+    # ticks[i] until ticks[i + 1]. seconds[i] is where each piece starts.
+    def __init__(self, ticks_per_beat: int, ticks: np.ndarray, tempos: np.ndarray):
+        self.ticks_per_beat = ticks_per_beat
+        self.ticks = np.asarray(ticks, dtype=np.int64)
+        self.tempos = np.asarray(tempos, dtype=np.int64)
+        assert len(self.ticks) > 0 and self.ticks[0] == 0, "Tempo map must start at tick 0"
+        self.scales = self.tempos * 1e-6 / ticks_per_beat
+        self.seconds = np.zeros(len(self.ticks), dtype=np.float64)
+        self.seconds[1:] = np.cumsum(np.diff(self.ticks) * self.scales[:-1])
+
+    @classmethod
+    def default(cls, ticks_per_beat: int = DEFAULT_TICKS_PER_BEAT) -> "TempoMap":
+        return cls(ticks_per_beat, np.zeros(1, dtype=np.int64), np.array([DEFAULT_TEMPO]))
+
+    @classmethod
+    def from_changes(cls, ticks_per_beat: int, change_ticks: np.ndarray, change_tempos: np.ndarray) -> "TempoMap":
+        # change_* in playback order. The last change at any given tick wins
+        ticks = np.r_[0, np.asarray(change_ticks, dtype=np.int64)]
+        tempos = np.r_[DEFAULT_TEMPO, np.asarray(change_tempos, dtype=np.int64)]
+        keep = np.r_[ticks[1:] != ticks[:-1], True]
+        return cls(ticks_per_beat, ticks[keep], tempos[keep])
+
+    @property
+    def is_constant(self) -> bool:
+        return len(self.ticks) == 1
+
+    def ticks_to_seconds(self, ticks: np.ndarray) -> np.ndarray:
+        ticks = np.asarray(ticks)
+        piece = np.searchsorted(self.ticks, ticks, side="right") - 1
+        return self.seconds[piece] + (ticks - self.ticks[piece]) * self.scales[piece]
+
+    def seconds_to_ticks(self, seconds: np.ndarray) -> np.ndarray:
+        # Unrounded
+        seconds = np.asarray(seconds, dtype=np.float64)
+        piece = np.maximum(np.searchsorted(self.seconds, seconds, side="right") - 1, 0)
+        return self.ticks[piece] + (seconds - self.seconds[piece]) / self.scales[piece]
+
+
+class ParsedSong(T.NamedTuple):
+    pitches: np.ndarray
+    ticks: np.ndarray
+    whens: np.ndarray
+    tempo_map: TempoMap
+
+    def notes(self) -> T.List[T.Tuple[int, float]]:
+        return list(zip(self.pitches.tolist(), self.whens.tolist()))
+
+
+# Absolute path -> ((mtime, size), parsed)
+_song_cache: T.Dict[str, T.Tuple[T.Tuple[float, int], ParsedSong]] = {}
+
+
+def _file_stamp(fname: str) -> T.Tuple[float, int]:
+    st = os.stat(fname)
+    return (st.st_mtime, st.st_size)
+
+
+def invalidate_song_cache(fname: T.Optional[str] = None):
+    if fname is None:
+        _song_cache.clear()
+    else:
+        _song_cache.pop(os.path.abspath(fname), None)
+
+
+def _get_mido() -> T.Any:
+    global _mido
+    if _mido is None:
+        import mido
+        mido.set_backend('mido.backends.rtmidi_python')
+        _mido = mido
+    return _mido
+
+
+def _parse_midi(fname: str) -> ParsedSong:
+    mid = _get_mido().MidiFile(fname)
+    # Playback order is by absolute tick, then track order, like mido's merged track
+    note_ticks: T.List[np.ndarray] = []
+    note_pitches: T.List[T.List[int]] = []
+    tempo_ticks: T.List[np.ndarray] = []
+    tempo_values: T.List[T.List[int]] = []
+    for track in mid.tracks:
+        abs_ticks = np.cumsum(np.fromiter((msg.time for msg in track), dtype=np.int64, count=len(track)))
+        note_ix = [i for i, msg in enumerate(track) if msg.type == 'note_on' or msg.type == 'note_off']
+        tempo_ix = [i for i, msg in enumerate(track) if msg.type == 'set_tempo']
+        note_ticks.append(abs_ticks[note_ix])
+        note_pitches.append([track[i].note for i in note_ix])
+        tempo_ticks.append(abs_ticks[tempo_ix])
+        tempo_values.append([track[i].tempo for i in tempo_ix])
+
+    all_tempo_ticks = np.concatenate(tempo_ticks) if tempo_ticks else np.zeros(0, dtype=np.int64)
+    all_tempos = np.array([t for values in tempo_values for t in values], dtype=np.int64)
+    tempo_order = np.argsort(all_tempo_ticks, kind="stable")
+    tempo_map = TempoMap.from_changes(mid.ticks_per_beat, all_tempo_ticks[tempo_order], all_tempos[tempo_order])
+
+    ticks = np.concatenate(note_ticks) if note_ticks else np.zeros(0, dtype=np.int64)
+    pitches = np.array([p for track_pitches in note_pitches for p in track_pitches], dtype=np.int64)
+    order = np.argsort(ticks, kind="stable")
+    ticks = ticks[order]
+    pitches = pitches[order]
+    return ParsedSong(pitches, ticks, tempo_map.ticks_to_seconds(ticks), tempo_map)
+
+
+def parse_song(fname: str) -> ParsedSong:
     print("Reading", fname)
     if os.path.splitext(os.path.basename(fname))[1] == ".mscz":
         print("Converting from MuseScore")
+        from musescore_integration import convert
         fname = convert(fname)
-        
-    mid = mido.MidiFile(fname)
-    all_notes: T.List[T.Tuple[int, float]] = []
-    t = 0
-    for msg in mid:
-        if msg.type == 'note_on' or msg.type == 'note_off':
-            which = msg.note
-            t += msg.time
-            when = t
-            all_notes.append((which, when))
-    return all_notes
+
+    key = os.path.abspath(fname)
+    stamp = _file_stamp(key)
+    cached = _song_cache.get(key, None)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    parsed = _parse_midi(key)
+    _song_cache[key] = (stamp, parsed)
+    return parsed
+
+
+def read_midi_file(fname: str) -> T.List[T.Tuple[int, float]]:
+    return parse_song(fname).notes()
 
 
 def _apply_penalty(freq: T.List[int], penalty: T.List[int], rshift: int) -> int:
@@ -57,60 +187,691 @@ def autotranspose(notes: T.List[T.Tuple[int, float]]) -> int:
     score = (len(notes)-best_penalty)/len(notes)
     return best_shift, score
 
-def dump_midi_file(notes: T.List[T.Tuple[int, float]], fname: T.Optional[str] = None) -> str:
-    if fname is None:
-        r_id = 0
-        while os.path.exists(fname := os.path.join(RECORDINGS, f"recording_{r_id}.midi")):
-            r_id += 1
-    
-    f = mido.MidiFile(type=0) # 0 - single channel, 1 - sync channels, 2 - async channels
-    track = f.add_track("main")
-    held_pitches = set()
-    last_time = 0
-    for (what, when) in sorted(notes, key = lambda what_and_when: what_and_when[1]):
-        if what in held_pitches:
-            msg_type = "note_off"
-            held_pitches.remove(what)
+def _read_song_header(fname: str, header: bytes) -> T.Tuple[int, float, int, int]:
+    # (transpose, score, metadata length, number of events)
+    if len(header) < SONG_HEADER.size:
+        raise ValueError(f"Not a compiled song: {fname}")
+    magic, version, n_pitches, transpose, score, metadata_len, n_events = SONG_HEADER.unpack_from(header, 0)
+    if magic != SONG_MAGIC or version != SONG_VERSION or n_pitches != N_MIDI_PITCHES:
+        raise ValueError(f"Not a compiled song: {fname}")
+    return transpose, score, metadata_len, n_events
+
+
+def _source_changed(metadata: T.Dict[str, T.Any]) -> bool:
+    # A source that's gone can't be compared, so the compiled copy stands on its own
+    source = metadata.get("source", None)
+    if not source or not os.path.exists(source):
+        return False
+    return os.path.getmtime(source) != metadata.get("source_mtime", None)
+
+
+class CompiledSong:
+    def __init__(
+        self,
+        offsets: np.ndarray,
+        times: np.ndarray,
+        transpose: int,
+        score: float,
+        metadata: T.Dict[str, T.Any],
+        buffer: T.Optional[mmap.mmap] = None,
+    ):
+        self.offsets = offsets
+        self.times = times
+        self.transpose = transpose
+        self.score = score
+        self.metadata = metadata
+        # Keeps the mapping alive for as long as the views into it are
+        self._buffer = buffer
+
+    @classmethod
+    def from_notes(cls, notes: T.List[T.Tuple[int, float]], metadata: T.Optional[T.Dict[str, T.Any]] = None) -> "CompiledSong":
+        pitches, whens = notes_to_arrays(notes)
+        return cls.from_arrays(pitches, whens, metadata)
+
+    @classmethod
+    def from_arrays(
+        cls,
+        pitches: np.ndarray,
+        whens: np.ndarray,
+        metadata: T.Optional[T.Dict[str, T.Any]] = None,
+        transpose_and_score: T.Optional[T.Tuple[int, float]] = None,
+    ) -> "CompiledSong":
+        if len(pitches) and (pitches.min() < 0 or pitches.max() >= N_MIDI_PITCHES):
+            raise ValueError("Pitch out of MIDI range")
+        # By pitch, then by time, keeping file order for ties
+        order = np.argsort(whens, kind="stable")
+        order = order[np.argsort(pitches[order], kind="stable")]
+        times = np.ascontiguousarray(whens[order])
+        counts = np.bincount(pitches, minlength=N_MIDI_PITCHES)
+        offsets = np.zeros(N_MIDI_PITCHES + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum(counts)
+
+        if transpose_and_score is not None:
+            transpose, score = transpose_and_score
+        elif len(pitches):
+            transpose, score = autotranspose([(int(p), 0.0) for p in pitches])
         else:
-            msg_type = "note_on"
-            held_pitches.add(what)
-        # when is in abs time, we need it in tick-delta time
-        delta_seconds = when - last_time
-        last_time = when
-        # Convert to ticks. 1 beat = 1 second
-        n_ticks = mido.second2tick(delta_seconds, DEFAULT_TICKS_PER_BEAT, DEFAULT_TEMPO)
-
-        msg = mido.Message(type=msg_type, note=what, velocity=127, time=int(n_ticks))
-        track.append(msg)
-    f.save(fname)
+            transpose, score = 0, 1.0
+        return cls(offsets, times, transpose, score, dict(metadata or {}))
+
+    @classmethod
+    def load(cls, fname: str) -> "CompiledSong":
+        with open(fname, "rb") as f:
+            # Read-only and shared, so several overlays reuse the same pages
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        transpose, score, metadata_len, n_events = _read_song_header(fname, buffer[:SONG_HEADER_SIZE])
+        at = SONG_HEADER_SIZE
+        offsets = np.frombuffer(buffer, dtype="<u8", count=N_MIDI_PITCHES + 1, offset=at)
+        at += offsets.nbytes
+        times = np.frombuffer(buffer, dtype="<f8", count=n_events, offset=at)
+        at += times.nbytes
+        metadata = json.loads(bytes(buffer[at:at + metadata_len]).decode("utf-8"))
+        return cls(offsets, times, transpose, score, metadata, buffer)
+
+    @staticmethod
+    def read_metadata(fname: str) -> T.Dict[str, T.Any]:
+        # Without mapping the events
+        with open(fname, "rb") as f:
+            _, _, metadata_len, n_events = _read_song_header(fname, f.read(SONG_HEADER_SIZE))
+            f.seek(SONG_HEADER_SIZE + 8 * (N_MIDI_PITCHES + 1 + n_events))
+            return json.loads(f.read(metadata_len).decode("utf-8"))
+
+
+    def save(self, fname: str) -> str:
+        metadata = json.dumps(self.metadata).encode("utf-8")
+        header = SONG_HEADER.pack(
+            SONG_MAGIC, SONG_VERSION, N_MIDI_PITCHES, int(self.transpose), float(self.score),
+            len(metadata), len(self.times),
+        )
+        with open(fname, "wb") as f:
+            f.write(header.ljust(SONG_HEADER_SIZE, b"\x00"))
+            f.write(np.ascontiguousarray(self.offsets, dtype="<u8").tobytes())
+            f.write(np.ascontiguousarray(self.times, dtype="<f8").tobytes())
+            f.write(metadata)
+        return fname
+
+    @property
+    def n_notes(self) -> int:
+        return len(self.times)
+
+    @property
+    def duration(self) -> float:
+        return float(self.times.max()) if len(self.times) else 0.0
+
+    def pitches(self) -> np.ndarray:
+        return np.flatnonzero(np.diff(self.offsets.astype(np.int64)))
+
+    def timeline(self, pitch: int) -> np.ndarray:
+        return self.times[int(self.offsets[pitch]):int(self.offsets[pitch + 1])]
+
+    def to_arrays(self) -> T.Tuple[np.ndarray, np.ndarray]:
+        # (pitches, whens) in time order
+        counts = np.diff(self.offsets.astype(np.int64))
+        pitches = np.repeat(np.arange(N_MIDI_PITCHES), counts)
+        order = np.argsort(self.times, kind="stable")
+        return pitches[order], np.asarray(self.times)[order]
+
+    def with_chords_grouped(self, tolerance: float) -> "CompiledSong":
+        pitches, whens = self.to_arrays()
+        return CompiledSong.from_arrays(
+            pitches,
+            group_chords(pitches, whens, tolerance),
+            self.metadata,
+            (self.transpose, self.score),
+        )
+
+
+def compile_song(fname: str, out_fname: T.Optional[str] = None) -> str:
+    if out_fname is None:
+        bn = os.path.splitext(os.path.basename(fname))[0]
+        out_fname = os.path.join(COMPILED, f"{bn}{COMPILED_EXT}")
+    song = CompiledSong.from_notes(read_midi_file(fname), metadata={
+        "name": os.path.splitext(os.path.basename(fname))[0],
+        "source": os.path.abspath(fname),
+        "source_mtime": os.path.getmtime(fname),
+    })
+    return song.save(out_fname)
+
+
+def load_song(fname: str, chord_tolerance: float = 0.0) -> CompiledSong:
+    if os.path.splitext(fname)[1].lower() == COMPILED_EXT:
+        song = CompiledSong.load(fname)
+    else:
+        parsed = parse_song(fname)
+        song = CompiledSong.from_arrays(parsed.pitches, parsed.whens, {"ticks_per_beat": parsed.tempo_map.ticks_per_beat})
+    if chord_tolerance > 0:
+        song = song.with_chords_grouped(chord_tolerance)
+    return song
+
+
+def _note_recording_name(basename: str) -> None:
+    global _next_recording_id
+    match = RECORDING_NAME.match(basename)
+    if match is not None:
+        _next_recording_id = max(_next_recording_id or 0, int(match.group(1)) + 1)
+
+
+def next_recording_path() -> str:
+    global _next_recording_id
+    if _next_recording_id is None:
+        # Only if discover_files hasn't already told us what's there
+        _next_recording_id = 0
+        for each_file in os.listdir(RECORDINGS):
+            _note_recording_name(os.path.splitext(each_file)[0].lower())
+    while os.path.exists(fname := os.path.join(RECORDINGS, f"recording_{_next_recording_id}.midi")):
+        _next_recording_id += 1
+    _next_recording_id += 1
     return fname
 
 
-def discover_files() -> T.Dict[str, str]:
-    sources = [
-        "D:\\Software\\Code\\PythonScripts\\MIDI\\midi_control\\data",
-        "D:\\OneDrive\\Sheet Music\\MuseScoreDownloads\\MIDI",
-        "D:\\OneDrive\\Sheet Music\\MuseScoreDownloads\\Muse",
-        "D:\\OneDrive\\Sheet Music\\Piano Music\\Piano Music\\MIDIs",
-        RECORDINGS,
-    ]
+def notes_to_arrays(notes: T.List[T.Tuple[int, float]]) -> T.Tuple[np.ndarray, np.ndarray]:
+    pitches = np.fromiter((what for (what, _) in notes), dtype=np.int64, count=len(notes))
+    whens = np.fromiter((when for (_, when) in notes), dtype=np.float64, count=len(notes))
+    return pitches, whens
+
+
+def toggle_occurrence(pitches: np.ndarray) -> np.ndarray:
+    # How many times each pitch has come up before, in array order. Even is an
+    # onset, odd is a release.
+    by_pitch = np.argsort(pitches, kind="stable")
+    sorted_pitches = pitches[by_pitch]
+    group_start = np.diff(sorted_pitches, prepend=-1) != 0
+    start_ix = np.maximum.accumulate(np.where(group_start, np.arange(len(pitches)), 0))
+    occurrence = np.empty(len(pitches), dtype=np.int64)
+    occurrence[by_pitch] = np.arange(len(pitches)) - start_ix
+    return occurrence
+
+
+def group_chords(pitches: np.ndarray, whens: np.ndarray, tolerance: float) -> np.ndarray:
+    # Snap onsets within `tolerance` of a chord's first onset onto that onset's
+    # time, so a rolled or sloppy chord plays as one. Releases don't move.
+    # Returns the new whens, in the same order as the input.
+    if len(whens) == 0:
+        return np.array(whens, dtype=np.float64)
+    order = np.argsort(whens, kind="stable")
+    sorted_pitches = pitches[order]
+    sorted_whens = whens[order]
+    is_onset = toggle_occurrence(sorted_pitches) % 2 == 0
 
-    all_found: T.Dict[str, str] = {}
+    onset_ix = np.flatnonzero(is_onset)
+    onset_whens = sorted_whens[onset_ix]
+    # Measured from the chord's first onset, so a fast run doesn't chain into one
+    # chord. Each onset's chord would end where next_start points; the chords are
+    # the chain 0, next_start[0], ... found by pointer doubling, as each pass adds
+    # the starts 2**k further along from every start found so far.
+    n_onsets = len(onset_ix)
+    next_start = np.r_[np.searchsorted(onset_whens, onset_whens + tolerance, side="right"), n_onsets]
+    is_start = np.zeros(n_onsets + 1, dtype=bool)
+    is_start[0] = True
+    jump = next_start
+    for _ in range(max(n_onsets, 1).bit_length()):
+        is_start[jump[is_start]] = True
+        jump = jump[jump]
+    chord_start = np.maximum.accumulate(np.where(is_start[:n_onsets], np.arange(n_onsets), 0))
+    snapped = sorted_whens.copy()
+    snapped[onset_ix] = onset_whens[chord_start]
 
-    for each_dir in sources:
+    # Never move an onset before the release that came before it on that pitch
+    by_pitch = np.argsort(sorted_pitches, kind="stable")
+    same_pitch_as_prev = np.r_[False, sorted_pitches[by_pitch][1:] == sorted_pitches[by_pitch][:-1]]
+    prev_when = np.full(len(snapped), -np.inf)
+    prev_when[by_pitch[same_pitch_as_prev]] = sorted_whens[by_pitch[np.flatnonzero(same_pitch_as_prev) - 1]]
+    snapped = np.maximum(snapped, prev_when)
+
+    result = np.empty_like(snapped)
+    result[order] = snapped
+    return result
+
+
+def _encode_variable_ints(values: np.ndarray) -> T.Tuple[np.ndarray, np.ndarray]:
+    # Returns (n_bytes, bytes) where bytes is [len(values), 4], left-aligned
+    if len(values) and (values.min() < 0 or values.max() > MAX_VARIABLE_INT):
+        raise ValueError("Delta time doesn't fit in a MIDI variable-length quantity")
+    n_bytes = 1 + (values >= (1 << 7)) + (values >= (1 << 14)) + (values >= (1 << 21))
+    encoded = np.zeros((len(values), 4), dtype=np.uint8)
+    for k in range(4):
+        # Byte k holds bits (n-1-k)*7 and up; every byte but the last has the high bit set
+        shift = 7 * (n_bytes - 1 - k)
+        group = (values >> np.maximum(shift, 0)) & 0x7F
+        continuation = np.where(k < n_bytes - 1, 0x80, 0)
+        encoded[:, k] = np.where(k < n_bytes, group | continuation, 0)
+    return n_bytes, encoded
+
+
+def encode_midi_track(pitches: np.ndarray, whens: np.ndarray, tempo_map: T.Optional[TempoMap] = None) -> bytes:
+    # Same bytes mido writes for a type 0 file with a "main" track of
+    # note_on / note_off toggles, running status included. With a tempo map,
+    # its changes are written as set_tempo events.
+    if len(pitches) and (pitches.min() < 0 or pitches.max() > 127):
+        raise ValueError("Pitch out of MIDI range")
+    if tempo_map is None:
+        tempo_map = TempoMap.default()
+    order = np.argsort(whens, kind="stable")
+    pitches = pitches[order]
+    whens = whens[order]
+
+    # Each pitch alternates on / off, in time order
+    status = np.where(toggle_occurrence(pitches) % 2 == 0, NOTE_ON_STATUS, NOTE_OFF_STATUS)
+
+    # Tempo changes to write, other than the default tempo at the start
+    write_tempo = np.ones(len(tempo_map.ticks), dtype=bool)
+    write_tempo[0] = tempo_map.tempos[0] != DEFAULT_TEMPO
+    tempo_ticks = tempo_map.ticks[write_tempo]
+    tempos = tempo_map.tempos[write_tempo]
+
+    if len(tempo_ticks) == 0 and tempo_map.ticks_per_beat == DEFAULT_TICKS_PER_BEAT:
+        # when is in abs time, we need it in tick-delta time. 1 beat = 1 second
+        delta_seconds = np.diff(whens, prepend=0.0)
+        note_ticks = np.cumsum(np.round(tempo_map.seconds_to_ticks(delta_seconds)).astype(np.int64))
+    else:
+        note_ticks = np.round(tempo_map.seconds_to_ticks(whens)).astype(np.int64)
+
+    # Tempo changes go before notes on the same tick
+    n_tempo, n_notes = len(tempo_ticks), len(pitches)
+    event_ticks = np.r_[tempo_ticks, note_ticks]
+    is_note = np.r_[np.zeros(n_tempo, dtype=bool), np.ones(n_notes, dtype=bool)]
+    event_order = np.lexsort((np.arange(n_tempo + n_notes), is_note, event_ticks))
+    event_ticks = event_ticks[event_order]
+    is_note = is_note[event_order]
+
+    # Event bodies, left-aligned, up to 6 bytes each
+    body = np.zeros((n_tempo + n_notes, 6), dtype=np.uint8)
+    body_len = np.zeros(n_tempo + n_notes, dtype=np.int64)
+    tempo_body = np.zeros((n_tempo, 6), dtype=np.uint8)
+    tempo_body[:, 0:3] = (0xFF, 0x51, 0x03)
+    tempo_body[:, 3] = (tempos >> 16) & 0xFF
+    tempo_body[:, 4] = (tempos >> 8) & 0xFF
+    tempo_body[:, 5] = tempos & 0xFF
+    all_status = np.r_[np.zeros(n_tempo, dtype=np.int64), status][event_order]
+    all_pitches = np.r_[np.zeros(n_tempo, dtype=np.int64), pitches][event_order]
+    tempo_rows = np.flatnonzero(~is_note)
+    body[tempo_rows] = tempo_body[event_order[tempo_rows]]
+    body_len[tempo_rows] = 6
+
+    # Running status: any meta message (the track name included) resets it
+    prev_status = np.r_[-1, np.where(is_note, all_status, -1)[:-1]]
+    has_status = is_note & (all_status != prev_status)
+    note_rows = np.flatnonzero(is_note)
+    status_rows = np.flatnonzero(has_status)
+    body[status_rows, 0] = all_status[status_rows]
+    note_col = has_status[note_rows].astype(np.int64)
+    body[note_rows, note_col] = all_pitches[note_rows]
+    body[note_rows, note_col + 1] = 127
+    body_len[note_rows] = note_col + 2
+
+    delta_ticks = np.diff(event_ticks, prepend=0)
+    n_time_bytes, time_bytes = _encode_variable_ints(delta_ticks)
+    event_sizes = n_time_bytes + body_len
+    offsets = np.cumsum(event_sizes) - event_sizes
+
+    events = np.zeros(int(event_sizes.sum()), dtype=np.uint8)
+    for k in range(4):
+        has_byte = k < n_time_bytes
+        events[offsets[has_byte] + k] = time_bytes[has_byte, k]
+    body_at = offsets + n_time_bytes
+    for k in range(6):
+        has_byte = k < body_len
+        events[body_at[has_byte] + k] = body[has_byte, k]
+
+    data = bytearray()
+    track_name = b"main"
+    data.extend(b"\x00\xff\x03" + bytes([len(track_name)]) + track_name)
+    data.extend(events.tobytes())
+    data.extend(b"\x00\xff\x2f\x00")
+    return bytes(data)
+
+
+def encode_midi_file(pitches: np.ndarray, whens: np.ndarray, tempo_map: T.Optional[TempoMap] = None) -> bytes:
+    track = encode_midi_track(pitches, whens, tempo_map)
+    ticks_per_beat = tempo_map.ticks_per_beat if tempo_map is not None else DEFAULT_TICKS_PER_BEAT
+    # 0 - single channel, 1 - sync channels, 2 - async channels
+    header = struct.pack(">hhh", 0, 1, ticks_per_beat)
+    return (
+        b"MThd" + struct.pack(">L", len(header)) + header
+        + b"MTrk" + struct.pack(">L", len(track)) + track
+    )
+
+
+def dump_midi_arrays(pitches: np.ndarray, whens: np.ndarray, fname: T.Optional[str] = None, tempo_map: T.Optional[TempoMap] = None) -> str:
+    if fname is None:
+        fname = next_recording_path()
+    with open(fname, "wb") as f:
+        f.write(encode_midi_file(pitches, whens, tempo_map))
+    return fname
+
+
+def dump_midi_file(notes: T.List[T.Tuple[int, float]], fname: T.Optional[str] = None, tempo_map: T.Optional[TempoMap] = None) -> str:
+    pitches, whens = notes_to_arrays(notes)
+    return dump_midi_arrays(pitches, whens, fname, tempo_map)
+
+
+STRESS_KINDS = ("trill", "chords", "long", "overlap", "tempo")
+# Every white key the overlay can play, lowest to highest
+STRESS_PITCHES = np.array([48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72, 74, 76, 77, 79, 81, 83])
+
+
+def generate_stress_song(
+    kind: str,
+    notes_per_sec: float,
+    seconds: float = 30.0,
+    seed: int = 0,
+) -> T.Tuple[T.List[T.Tuple[int, float]], T.Optional[TempoMap]]:
+    # Pathological workloads for the playback path. Returns toggles like
+    # read_midi_file, and the tempo map to write them with (for "tempo").
+    #   trill   - two neighbouring keys alternating, each note held 90% of its slot
+    #   chords  - 10-note chords, notes_per_sec / 10 of them a second
+    #   long    - random notes, meant for a large `seconds`
+    #   overlap - the same pitch struck again before it was released
+    #   tempo   - 16th notes on a beat grid whose tempo changes every beat
+    rng = np.random.default_rng(seed)
+    n_notes = max(1, int(notes_per_sec * seconds))
+    slot = 1.0 / notes_per_sec
+    tempo_map: T.Optional[TempoMap] = None
+    if kind == "trill":
+        onsets = np.arange(n_notes) * slot
+        pitches = np.where(np.arange(n_notes) % 2 == 0, STRESS_PITCHES[10], STRESS_PITCHES[11])
+        lengths = np.full(n_notes, slot * 0.9)
+    elif kind == "chords":
+        n_chords = max(1, n_notes // 10)
+        chord_slot = 10 * slot
+        onsets = np.repeat(np.arange(n_chords) * chord_slot, 10)
+        pitches = np.concatenate([rng.choice(STRESS_PITCHES, 10, replace=False) for _ in range(n_chords)])
+        lengths = np.full(len(onsets), chord_slot * 0.8)
+    elif kind == "long":
+        onsets = np.sort(rng.uniform(0, seconds, n_notes))
+        pitches = rng.choice(STRESS_PITCHES, n_notes)
+        lengths = rng.uniform(0.05, 0.5, n_notes)
+        # Don't let a pitch overlap itself, that's what "overlap" is for
+        order = np.argsort(pitches, kind="stable")
+        for pitch in np.unique(pitches):
+            ix = order[pitches[order] == pitch]
+            next_onsets = np.r_[onsets[ix][1:], np.inf]
+            lengths[ix] = np.minimum(lengths[ix], np.maximum(next_onsets - onsets[ix] - 0.01, 0.005))
+    elif kind == "overlap":
+        onsets = np.arange(n_notes) * slot
+        pitches = STRESS_PITCHES[(np.arange(n_notes) // 2) % len(STRESS_PITCHES)]
+        # Pairs of strikes on one pitch, the second before the first is released
+        lengths = np.full(n_notes, slot * 1.5)
+    elif kind == "tempo":
+        ticks_per_beat = DEFAULT_TICKS_PER_BEAT
+        sixteenth = ticks_per_beat // 4
+        n_beats = n_notes // 4 + 1
+        # Tempo around notes_per_sec 16ths a second, +-30% every beat
+        base_tempo = 4e6 / notes_per_sec
+        tempos = (base_tempo * rng.uniform(0.7, 1.3, n_beats)).astype(np.int64)
+        tempo_map = TempoMap(ticks_per_beat, np.arange(n_beats) * ticks_per_beat, tempos)
+        note_ticks = np.arange(n_notes) * sixteenth
+        onsets = tempo_map.ticks_to_seconds(note_ticks)
+        pitches = rng.choice(STRESS_PITCHES, n_notes)
+        lengths = tempo_map.ticks_to_seconds(note_ticks + sixteenth * 3 // 4) - onsets
+        # Same pitch twice in a row would overlap itself
+        pitches[1:] = np.where(pitches[1:] == pitches[:-1], STRESS_PITCHES[(np.searchsorted(STRESS_PITCHES, pitches[1:]) + 1) % len(STRESS_PITCHES)], pitches[1:])
+    else:
+        raise ValueError(f"Unknown stress song {kind}, expected one of {STRESS_KINDS}")
+
+    notes = list(zip(pitches.tolist(), onsets.tolist())) + list(zip(pitches.tolist(), (onsets + lengths).tolist()))
+    notes.sort(key=lambda what_and_when: what_and_when[1])
+    return notes, tempo_map
+
+
+def write_stress_song(kind: str, notes_per_sec: float, seconds: float = 30.0, fname: T.Optional[str] = None, seed: int = 0) -> str:
+    notes, tempo_map = generate_stress_song(kind, notes_per_sec, seconds, seed)
+    if fname is None:
+        fname = os.path.join(RECORDINGS, f"stress_{kind}_{notes_per_sec:g}.mid")
+    return dump_midi_file(notes, fname, tempo_map)
+
+
+LIBRARY_SOURCES = [
+    "D:\\Software\\Code\\PythonScripts\\MIDI\\midi_control\\data",
+    "D:\\OneDrive\\Sheet Music\\MuseScoreDownloads\\MIDI",
+    "D:\\OneDrive\\Sheet Music\\MuseScoreDownloads\\Muse",
+    "D:\\OneDrive\\Sheet Music\\Piano Music\\Piano Music\\MIDIs",
+    RECORDINGS,
+    COMPILED,
+]
+SONG_EXTS = (".mid", ".midi", ".mscz", COMPILED_EXT)
+_SEPARATORS = re.compile(r"[\s_\-.]+")
+
+
+class AmbiguousSongName(KeyError):
+    def __init__(self, name: str, candidates: T.List[str]):
+        super().__init__(name)
+        self.name = name
+        self.candidates = candidates
+
+    def __str__(self) -> str:
+        return f"{self.name} could be any of: " + ", ".join(self.candidates)
+
+
+def _normalize_name(name: str) -> str:
+    return _SEPARATORS.sub(" ", name.lower()).strip()
+
+
+def _trigrams(normalized: str) -> T.Set[str]:
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _is_conversion_of(mid_path: str, mscz_path: str) -> bool:
+    # musescore_integration.convert() writes <name>.mid into its conversion
+    # directory, so the pair is one song, not a collision
+    from musescore_integration import conversion_dir
+    stem = os.path.splitext(os.path.basename(mscz_path))[0]
+    expected = os.path.join(conversion_dir, f"{stem}.mid")
+    return os.path.normcase(os.path.normpath(mid_path)) == os.path.normcase(os.path.normpath(expected))
+
+
+class LibraryIndex:
+    # Song name -> files, with a trigram index over the names for fuzzy lookups.
+    # A name with more than one source file is ambiguous: resolve() raises
+    # AmbiguousSongName and files() leaves it out, rather than picking one by
+    # directory order. A compiled .gmsong is derived from its source, so it
+    # never makes a name ambiguous and is preferred when present, unless its
+    # source changed since (see drop_stale_compiled).
+    def __init__(self, entries: T.Iterable[T.Tuple[str, str]] = ()):
+        self._paths: T.Dict[str, T.List[str]] = {}
+        self._names: T.List[str] = []
+        self._ids: T.Dict[str, int] = {}
+        self._n_trigrams: T.List[int] = []
+        self._alive: T.List[bool] = []
+        self._postings: T.Dict[str, T.List[int]] = {}
+        # Arrays built from the above on first use, dropped when they change.
+        # Postings only ever grow, so theirs are extended rather than rebuilt.
+        self._posting_arrays: T.Dict[str, np.ndarray] = {}
+        self._n_trigrams_array: T.Optional[np.ndarray] = None
+        self._alive_array: T.Optional[np.ndarray] = None
+        self._sorted_names: T.Optional[T.List[str]] = None
+        self._sorted_ids: np.ndarray = np.zeros(0, dtype=np.intp)
+        for (name, path) in entries:
+            self.add(name, path)
+
+    @classmethod
+    def scan(cls, sources: T.Optional[T.List[str]] = None) -> "LibraryIndex":
+        index = cls()
+        for each_dir in (LIBRARY_SOURCES if sources is None else sources):
+            index.add_directory(each_dir)
+        index.drop_stale_compiled()
+        return index
+
+    def add_directory(self, each_dir: str):
         each_dir = os.path.abspath(each_dir)
-        files_in_dir = os.listdir(each_dir)
-        for each_file in files_in_dir:
+        if not os.path.isdir(each_dir):
+            return
+        is_recordings = (each_dir == os.path.abspath(RECORDINGS))
+        for each_file in os.listdir(each_dir):
             bn, ext = os.path.splitext(os.path.basename(each_file))
-            ext = ext.lower()
             bn = bn.lower()
-            if ext == ".mid" or ext == ".midi":
-                all_found[bn] = os.path.join(each_dir, each_file)
-            if ext == ".mscz" and bn not in all_found:
-                all_found[bn] = os.path.join(each_dir, each_file)
+            if is_recordings:
+                _note_recording_name(bn)
+            if ext.lower() in SONG_EXTS:
+                self.add(bn, os.path.join(each_dir, each_file))
 
-    
-    return all_found
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._paths
+
+    def names(self) -> T.List[str]:
+        return list(self._paths)
+
+    def add(self, name: str, path: str):
+        name = name.lower()
+        path = os.path.abspath(path)
+        paths = self._paths.setdefault(name, [])
+        if path in paths:
+            return
+        paths.append(path)
+        if name in self._ids:
+            ix = self._ids[name]
+            if not self._alive[ix]:
+                self._alive[ix] = True
+                self._alive_array = None
+                self._sorted_names = None
+            return
+        ix = len(self._names)
+        self._ids[name] = ix
+        self._names.append(name)
+        self._alive.append(True)
+        grams = _trigrams(_normalize_name(name))
+        self._n_trigrams.append(len(grams))
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(ix)
+        self._n_trigrams_array = None
+        self._alive_array = None
+        self._sorted_names = None
+
+    def remove(self, path: str):
+        path = os.path.abspath(path)
+        name = os.path.splitext(os.path.basename(path))[0].lower()
+        paths = self._paths.get(name, None)
+        if paths is None or path not in paths:
+            return
+        paths.remove(path)
+        if not paths:
+            # Its trigrams stay in the postings, just never match again
+            del self._paths[name]
+            self._alive[self._ids[name]] = False
+            self._alive_array = None
+            self._sorted_names = None
+
+    def drop_stale_compiled(self):
+        # A source edited since it was compiled (say while the overlay was
+        # closed) would otherwise be shadowed by the old compiled copy
+        for paths in list(self._paths.values()):
+            for path in [p for p in paths if os.path.splitext(p)[1].lower() == COMPILED_EXT]:
+                try:
+                    metadata = CompiledSong.read_metadata(path)
+                except (OSError, ValueError) as e:
+                    # Unreadable, or from an older format
+                    print(f"Ignoring {path}: {e}")
+                    self.remove(path)
+                    continue
+                if _source_changed(metadata):
+                    print(f"Ignoring {path}, its source changed since it was compiled")
+                    self.remove(path)
+
+    def candidates(self, name: str) -> T.List[str]:
+        return list(self._paths.get(name.lower(), []))
+
+    def _sources(self, paths: T.List[str]) -> T.List[str]:
+        sources = [p for p in paths if os.path.splitext(p)[1].lower() != COMPILED_EXT]
+        mids = [p for p in sources if os.path.splitext(p)[1].lower() != ".mscz"]
+        if len(mids) == 1 and len(sources) == 2 and _is_conversion_of(mids[0], next(p for p in sources if p != mids[0])):
+            return mids
+        return sources
+
+    def resolve(self, name: str) -> str:
+        # Also takes "name.ext", to pick one file of an ambiguous name
+        name = name.lower()
+        if name not in self._paths:
+            bn, ext = os.path.splitext(name)
+            matching = [p for p in self._paths.get(bn, []) if os.path.splitext(p)[1].lower() == ext]
+            if len(matching) == 1:
+                return matching[0]
+            suggestions = [found for (found, _) in self.search(name, 5)]
+            raise KeyError(f"No song called {name}" + (f", did you mean {', '.join(suggestions)}?" if suggestions else ""))
+        paths = self._paths[name]
+        compiled = [p for p in paths if os.path.splitext(p)[1].lower() == COMPILED_EXT]
+        sources = self._sources(paths)
+        if len(sources) > 1:
+            raise AmbiguousSongName(name, sources)
+        return compiled[-1] if compiled else sources[0]
+
+    def ambiguous(self) -> T.Dict[str, T.List[str]]:
+        return {name: sources for name, paths in self._paths.items() if len(sources := self._sources(paths)) > 1}
+
+    def files(self) -> T.Dict[str, str]:
+        # Every name that resolves to exactly one file
+        found: T.Dict[str, str] = {}
+        for name in self._paths:
+            try:
+                found[name] = self.resolve(name)
+            except AmbiguousSongName:
+                pass
+        return found
+
+    def _posting(self, gram: str) -> T.Optional[np.ndarray]:
+        ids = self._postings.get(gram, None)
+        if ids is None:
+            return None
+        array = self._posting_arrays.get(gram, None)
+        if array is None:
+            array = self._posting_arrays[gram] = np.array(ids, dtype=np.intp)
+        elif len(array) < len(ids):
+            array = self._posting_arrays[gram] = np.concatenate((array, np.array(ids[len(array):], dtype=np.intp)))
+        return array
+
+    def search(self, query: str, limit: int = 10) -> T.List[T.Tuple[str, float]]:
+        # Ranked (name, score). Exact match first, then names starting with the
+        # query, then by trigram similarity (shared / total distinct trigrams).
+        normalized = _normalize_name(query)
+        if not normalized or not self._paths:
+            return []
+        n = len(self._names)
+        if self._n_trigrams_array is None:
+            self._n_trigrams_array = np.array(self._n_trigrams, dtype=np.float64)
+        if self._alive_array is None:
+            self._alive_array = np.array(self._alive, dtype=bool)
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self._paths)
+            self._sorted_ids = np.array([self._ids[name] for name in self._sorted_names], dtype=np.intp)
+        if len(self._posting_arrays) < len(self._postings):
+            # All at once, rather than a few ms on each query that meets new trigrams
+            for gram in self._postings.keys() - self._posting_arrays.keys():
+                self._posting(gram)
+
+        # Only names sharing a trigram with the query, or starting with it, get scored
+        grams = _trigrams(normalized)
+        postings = [array for gram in grams if (array := self._posting(gram)) is not None]
+        shared = np.bincount(np.concatenate(postings), minlength=n) if postings else np.zeros(n, dtype=np.intp)
+        lowered = query.lower()
+        lo = bisect.bisect_left(self._sorted_names, lowered)
+        hi = bisect.bisect_left(self._sorted_names, lowered + "\uffff")
+        is_prefixed = np.zeros(n, dtype=bool)
+        is_prefixed[self._sorted_ids[lo:hi]] = True
+
+        candidates = np.nonzero(((shared > 0) | is_prefixed) & self._alive_array)[0]
+        if len(candidates) == 0:
+            return []
+        shared_here = shared[candidates].astype(np.float64)
+        scores = shared_here / (len(grams) + self._n_trigrams_array[candidates] - shared_here)
+        scores += is_prefixed[candidates]
+        exact = self._ids.get(lowered, None)
+        if exact is not None:
+            scores += candidates == exact
+
+        limit = min(limit, len(candidates))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self._names[candidates[ix]], float(scores[ix])) for ix in top]
+
+
+def discover_files() -> T.Dict[str, str]:
+    index = LibraryIndex.scan()
+    for name, candidates in index.ambiguous().items():
+        print(f"Ambiguous song name {name}: {', '.join(candidates)}")
+    return index.files()
 
 
 def main():
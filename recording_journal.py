@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+import typing as T
+from collections import deque
+
+import numpy as np
+
+from read_notes import RECORDINGS, dump_midi_arrays
+
+JOURNAL_EXT = ".journal"
+JOURNAL_DTYPE = np.dtype([("when", "<f8"), ("pitch", "u1")])
+
+
+def new_journal_path() -> str:
+    return os.path.join(RECORDINGS, f"take_{time.strftime('%Y%m%d_%H%M%S')}{JOURNAL_EXT}")
+
+
+class RecordingJournal:
+    # Append-only log of (when, pitch) toggles. A writer thread flushes batches
+    # to disk, so a crash loses at most the last flush_interval of the take.
+    def __init__(self, fname: T.Optional[str] = None, flush_interval: float = 0.25):
+        self.fname = fname or new_journal_path()
+        self.flush_interval = flush_interval
+        self.n_written: int = 0
+        self._pending: T.Deque[T.Tuple[float, int]] = deque()
+        self._file: T.Optional[T.BinaryIO] = None
+        self._stop = threading.Event()
+        self._thread: T.Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._file = open(self.fname, "ab")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="recording-journal", daemon=True)
+        self._thread.start()
+
+    def append(self, pitch: int, when: float):
+        self._pending.append((when, pitch))
+
+    def flush(self):
+        batch: T.List[T.Tuple[float, int]] = []
+        while True:
+            try:
+                batch.append(self._pending.popleft())
+            except IndexError:
+                break
+        if not batch or self._file is None:
+            return
+        self._file.write(np.array(batch, dtype=JOURNAL_DTYPE).tobytes())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.n_written += len(batch)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_journal(journal_fname: str) -> T.Tuple[np.ndarray, np.ndarray]:
+    with open(journal_fname, "rb") as f:
+        raw = f.read()
+    # A crash can leave half a record at the end
+    n_records = len(raw) // JOURNAL_DTYPE.itemsize
+    records = np.frombuffer(raw, dtype=JOURNAL_DTYPE, count=n_records)
+    pitches = records["pitch"].astype(np.int64)
+    whens = records["when"]
+    return pitches, whens
+
+
+def finalize_journal(journal_fname: str, fname: T.Optional[str] = None, remove_journal: bool = True) -> str:
+    pitches, whens = read_journal(journal_fname)
+    out_fname = dump_midi_arrays(pitches, whens, fname)
+    if remove_journal:
+        os.remove(journal_fname)
+    return out_fname
+
+
+def recover_journals() -> T.List[str]:
+    # Turn takes left behind by a crash into regular recordings
+    recovered: T.List[str] = []
+    for each_file in sorted(os.listdir(RECORDINGS)):
+        if os.path.splitext(each_file)[1] == JOURNAL_EXT:
+            recovered.append(finalize_journal(os.path.join(RECORDINGS, each_file)))
+    return recovered
+
+
+def main():
+    for fname in recover_journals():
+        print("Recovered", fname)
+
+
+if __name__ == "__main__":
+    main()
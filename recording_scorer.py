@@ -0,0 +1,374 @@
+import os
+import time
+import typing as T
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from read_notes import N_MIDI_PITCHES, load_song, notes_to_arrays, read_midi_file, toggle_occurrence
+
+# Seconds either side of the warped reference a press can still count as that note
+DEFAULT_TOLERANCE = 0.15
+# Windows for the rougher matching passes the warp is estimated from
+WARP_WINDOWS = (0.3, 0.2)
+# Matched onsets either side the warp takes its median over
+WARP_NEIGHBOURS = 15
+# DTW frame length. A full-width pass at COARSE_HOP finds roughly where in
+# the song the take is, then the DTW_HOP pass stays within BAND_RADIUS seconds of that
+DTW_HOP = 0.2
+COARSE_HOP = 1.0
+BAND_RADIUS = 3.0
+# Added to every DTW step that isn't diagonal, so silence lined up with silence
+# doesn't let the path wander
+STEP_PENALTY = 0.1
+# DTW frames either side averaged into the warp
+SMOOTH_FRAMES = 2
+
+
+class KeyScore(T.NamedTuple):
+    pitch: int
+    n_expected: int
+    n_hit: int
+    n_missed: int
+    # Presses that didn't match any note of this key
+    n_wrong: int
+    median_error: float
+
+
+def onsets(pitches: np.ndarray, whens: np.ndarray) -> T.Tuple[np.ndarray, np.ndarray]:
+    # Just the presses out of a toggle list, in time order
+    is_onset = toggle_occurrence(pitches) % 2 == 0
+    order = np.argsort(whens[is_onset], kind="stable")
+    return pitches[is_onset][order], whens[is_onset][order]
+
+
+def onset_frames(pitches: np.ndarray, whens: np.ndarray, rows: np.ndarray, start: float, n_frames: int, hop: float) -> np.ndarray:
+    # (frame, pitch) counts of onsets, with half a count spilling into the
+    # neighbouring frames so a press near a frame edge still lines up
+    row = rows[pitches]
+    frame = np.clip(((whens - start) // hop).astype(np.int64), 0, n_frames - 1)
+    n_rows = int(rows.max()) + 1
+    counts = np.bincount(frame * n_rows + row, minlength=n_frames * n_rows).reshape(n_frames, n_rows).astype(np.float64)
+    blurred = counts.copy()
+    blurred[1:] += 0.5 * counts[:-1]
+    blurred[:-1] += 0.5 * counts[1:]
+    return blurred
+
+
+def banded_dtw(take_frames: np.ndarray, ref_frames: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> T.Tuple[np.ndarray, np.ndarray]:
+    # Subsequence dynamic time warping: every take frame is matched, but the path
+    # may start and end anywhere in the reference, so a take of part of the song
+    # lines up with just that part. Restricted to reference frames lo[i]:hi[i] for
+    # take frame i. Rows are vectorized: with A the best way into each cell from
+    # the row above, a row is min-accumulate(A - S) + S for S the row's running
+    # cost, which covers any run of steps along the row. Returns the path as
+    # (take, ref) frames.
+    penalty = STEP_PENALTY
+    ref_sq = (ref_frames ** 2).sum(axis=1)
+    take_sq = (take_frames ** 2).sum(axis=1)
+    rows: T.List[np.ndarray] = []
+    prev = np.zeros(0)
+    prev_lo = prev_hi = 0
+    for i in range(len(take_frames)):
+        l, h = int(lo[i]), int(hi[i])
+        # 0 when both frames are the same (or both empty), 1 when they share nothing
+        total = take_sq[i] + ref_sq[l:h]
+        cost = (total - 2 * (ref_frames[l:h] @ take_frames[i])) / (total + 1e-9)
+        # prev row over columns l-1 .. h-1, for the diagonal and the step down
+        if i == 0:
+            # Free to start at any reference frame
+            above = np.zeros(h - l + 1)
+        else:
+            above = np.full(h - l + 1, np.inf)
+            a, b = max(prev_lo, l - 1), min(prev_hi, h)
+            if a < b:
+                above[a - l + 1:b - l + 1] = prev[a - prev_lo:b - prev_lo]
+        into = np.minimum(above[:-1], above[1:] + penalty) + cost
+        running = np.cumsum(cost + penalty)
+        prev = np.minimum.accumulate(into - running) + running
+        prev_lo, prev_hi = l, h
+        rows.append(prev)
+
+    def at(i: int, j: int) -> float:
+        if i < 0 or j < int(lo[i]) or j >= int(hi[i]):
+            return np.inf
+        return float(rows[i][j - int(lo[i])])
+
+    path_take: T.List[int] = []
+    path_ref: T.List[int] = []
+    # Free to end at any reference frame too
+    i = len(take_frames) - 1
+    j = int(lo[i]) + int(np.argmin(rows[i]))
+    while True:
+        path_take.append(i)
+        path_ref.append(j)
+        if i == 0:
+            break
+        steps = ((i - 1, j - 1, 0.0), (i - 1, j, penalty), (i, j - 1, penalty))
+        i, j, _ = min(steps, key=lambda step: at(step[0], step[1]) + step[2])
+    return np.array(path_take[::-1], dtype=np.int64), np.array(path_ref[::-1], dtype=np.int64)
+
+
+def align(
+    ref_pitches: np.ndarray,
+    ref_whens: np.ndarray,
+    take_pitches: np.ndarray,
+    take_whens: np.ndarray,
+    hop: float = DTW_HOP,
+    coarse_hop: float = COARSE_HOP,
+) -> np.ndarray:
+    # Where each reference onset happens on the take's clock, as a shift to add.
+    # A full-width DTW on coarse frames places the take in the song, then a
+    # finer one within a band around that path follows the tempo. Reference
+    # frames the take doesn't cover keep the shift at the nearest end.
+    rows = np.full(N_MIDI_PITCHES, 0, dtype=np.int64)
+    used = np.union1d(ref_pitches, take_pitches)
+    rows[used] = np.arange(len(used))
+    # First onsets in the middle of frame 0
+    ref_start = ref_whens[0] - hop / 2
+    take_start = take_whens[0] - hop / 2
+
+    def frames(frame_hop: float) -> T.Tuple[np.ndarray, np.ndarray]:
+        n_ref = int((ref_whens[-1] - ref_start) // frame_hop) + 1
+        n_take = int((take_whens[-1] - take_start) // frame_hop) + 1
+        return (
+            onset_frames(take_pitches, take_whens, rows, take_start, n_take, frame_hop),
+            onset_frames(ref_pitches, ref_whens, rows, ref_start, n_ref, frame_hop),
+        )
+
+    coarse_take, coarse_ref = frames(coarse_hop)
+    full = np.full(len(coarse_take), len(coarse_ref))
+    coarse_path_take, coarse_path_ref = banded_dtw(coarse_take, coarse_ref, np.zeros_like(full), full)
+
+    take_frames, ref_frames = frames(hop)
+    n_ref = len(ref_frames)
+    # Reference span the coarse path gives each coarse take frame, widened by the band
+    coarse_lo = np.minimum.reduceat(coarse_path_ref, np.searchsorted(coarse_path_take, np.arange(len(coarse_take))))
+    coarse_hi = np.maximum.reduceat(coarse_path_ref, np.searchsorted(coarse_path_take, np.arange(len(coarse_take))))
+    coarse_row = np.minimum((np.arange(len(take_frames)) * hop // coarse_hop).astype(np.int64), len(coarse_take) - 1)
+    radius = BAND_RADIUS / hop
+    lo = np.clip(np.floor(coarse_lo[coarse_row] * coarse_hop / hop - radius), 0, n_ref - 1).astype(np.int64)
+    hi = np.clip(np.ceil((coarse_hi[coarse_row] + 1) * coarse_hop / hop + radius), 1, n_ref).astype(np.int64)
+    path_take, path_ref = banded_dtw(take_frames, ref_frames, lo, hi)
+
+    # Average take frame for each reference frame on the path
+    counts = np.bincount(path_ref, minlength=n_ref)
+    covered = counts > 0
+    mean_take = (np.bincount(path_ref, weights=path_take, minlength=n_ref) / np.maximum(counts, 1))[covered]
+    frame_times = ref_start + (np.flatnonzero(covered) + 0.5) * hop
+    shifts = (take_start + (mean_take + 0.5) * hop) - frame_times
+    # The path moves a whole frame at a time, a running mean evens that out
+    smooth = np.ones(2 * SMOOTH_FRAMES + 1) / (2 * SMOOTH_FRAMES + 1)
+    shifts = np.convolve(np.pad(shifts, SMOOTH_FRAMES, mode="edge"), smooth, mode="valid")
+    return np.interp(ref_whens, frame_times, shifts)
+
+
+def _nearest(sorted_values: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    # Index into sorted_values of the closest value to each query
+    ix = np.searchsorted(sorted_values, queries)
+    left = np.maximum(ix - 1, 0)
+    right = np.minimum(ix, len(sorted_values) - 1)
+    return np.where(np.abs(sorted_values[left] - queries) <= np.abs(sorted_values[right] - queries), left, right)
+
+
+def match_onsets(
+    ref_pitches: np.ndarray,
+    ref_whens: np.ndarray,
+    take_pitches: np.ndarray,
+    take_whens: np.ndarray,
+    window: float,
+) -> np.ndarray:
+    # Pairs each reference onset with the take onset of the same pitch it's
+    # closest to, if that's mutual and within `window`. ref_whens should already
+    # be on the take's clock. Returns, per reference onset, the take index or -1.
+    matched = np.full(len(ref_whens), -1, dtype=np.int64)
+    if len(ref_whens) == 0 or len(take_whens) == 0:
+        return matched
+    # Pitch and time folded into one sorted axis, with pitches far enough apart
+    # that the nearest neighbour never crosses into another pitch
+    start = min(ref_whens.min(), take_whens.min())
+    span = max(ref_whens.max(), take_whens.max()) - start + 2 * window + 1.0
+    ref_keys = ref_pitches * span + (ref_whens - start)
+    take_keys = take_pitches * span + (take_whens - start)
+    ref_order = np.argsort(ref_keys, kind="stable")
+    take_order = np.argsort(take_keys, kind="stable")
+    sorted_ref = ref_keys[ref_order]
+    sorted_take = take_keys[take_order]
+
+    nearest_take = _nearest(sorted_take, sorted_ref)
+    nearest_ref = _nearest(sorted_ref, sorted_take)
+    mutual = nearest_ref[nearest_take] == np.arange(len(sorted_ref))
+    close = np.abs(sorted_take[nearest_take] - sorted_ref) <= window
+    hit = mutual & close
+    matched[ref_order[hit]] = take_order[nearest_take[hit]]
+    return matched
+
+
+def estimate_warp(ref_whens: np.ndarray, shifts: np.ndarray, neighbours: int = WARP_NEIGHBOURS) -> np.ndarray:
+    # Running median of the matched onsets' shifts, `neighbours` either side in
+    # time order. Follows tempo drift and pauses without soaking up
+    # note-to-note timing. ref_whens must be sorted.
+    if len(ref_whens) == 0:
+        return shifts
+    window = np.lib.stride_tricks.sliding_window_view(np.pad(shifts, neighbours, mode="edge"), 2 * neighbours + 1)
+    return np.median(window, axis=1)
+
+
+@dataclass
+class TakeScore:
+    # Onsets only, in time order
+    ref_pitches: np.ndarray
+    ref_whens: np.ndarray
+    take_pitches: np.ndarray
+    take_whens: np.ndarray
+    # Per reference onset, the index of the take onset it matched or -1
+    matched: np.ndarray
+    # Where each reference onset was expected on the take's clock
+    expected_at: np.ndarray
+    offset: float
+    # Song seconds the take covers; reference onsets outside it aren't scored
+    covered: T.Tuple[float, float] = (0.0, 0.0)
+    elapsed: float = 0.0
+    names: T.Optional[T.List[T.Optional[str]]] = field(default=None, repr=False)
+
+    @property
+    def hit(self) -> np.ndarray:
+        return self.matched >= 0
+
+    @property
+    def wrong(self) -> np.ndarray:
+        # Per take onset, whether it matched nothing
+        wrong = np.ones(len(self.take_whens), dtype=bool)
+        wrong[self.matched[self.hit]] = False
+        return wrong
+
+    @property
+    def errors(self) -> np.ndarray:
+        # Seconds each matched press came after the (tempo-followed) reference
+        return self.take_whens[self.matched[self.hit]] - self.expected_at[self.hit]
+
+    @property
+    def drift(self) -> np.ndarray:
+        # How far the take's tempo wandered from the reference, per onset
+        return self.expected_at - self.ref_whens - self.offset
+
+    def per_key(self) -> T.List[KeyScore]:
+        hit = self.hit
+        n_expected = np.bincount(self.ref_pitches, minlength=N_MIDI_PITCHES)
+        n_hit = np.bincount(self.ref_pitches[hit], minlength=N_MIDI_PITCHES)
+        n_wrong = np.bincount(self.take_pitches[self.wrong], minlength=N_MIDI_PITCHES)
+        errors = self.errors
+        hit_pitches = self.ref_pitches[hit]
+        # Median error per pitch from one sort
+        order = np.lexsort((errors, hit_pitches))
+        starts = np.searchsorted(hit_pitches[order], np.arange(N_MIDI_PITCHES))
+        medians = np.full(N_MIDI_PITCHES, np.nan)
+        has_hits = n_hit > 0
+        medians[has_hits] = errors[order][starts[has_hits] + (n_hit[has_hits] - 1) // 2]
+        return [
+            KeyScore(int(p), int(n_expected[p]), int(n_hit[p]), int(n_expected[p] - n_hit[p]), int(n_wrong[p]), float(medians[p]))
+            for p in np.flatnonzero((n_expected > 0) | (n_wrong > 0))
+        ]
+
+    def summary(self) -> str:
+        n_ref = len(self.ref_whens)
+        n_hit = int(self.hit.sum())
+        errors = self.errors
+        lines = [
+            f"{n_hit} / {n_ref} notes hit ({n_hit / max(n_ref, 1) * 100:.1f}%), "
+            f"{n_ref - n_hit} missed, {int(self.wrong.sum())} wrong, "
+            f"take covers {self.covered[0]:.1f}-{self.covered[1]:.1f}s of the song, starting {self.offset:+.2f}s from it, "
+            f"scored in {self.elapsed * 1000:.1f}ms",
+        ]
+        if len(errors):
+            late = np.abs(errors)
+            lines.append(
+                f"timing ms: mean {errors.mean() * 1000:+.1f}, p50 |err| {np.median(late) * 1000:.1f}, "
+                f"p90 {np.percentile(late, 90) * 1000:.1f}, max {late.max() * 1000:.1f}; "
+                f"tempo drift {self.drift.min() * 1000:+.0f}..{self.drift.max() * 1000:+.0f}ms"
+            )
+        lines.append("key   notes   hit  missed  wrong  median ms")
+        for row in self.per_key():
+            name = self.names[row.pitch] if self.names is not None else None
+            label = f"{name or '-'} {row.pitch:>3}"
+            median = "" if np.isnan(row.median_error) else f"{row.median_error * 1000:+.1f}"
+            lines.append(f"{label:<5} {row.n_expected:>5} {row.n_hit:>5} {row.n_missed:>7} {row.n_wrong:>6}  {median:>9}")
+        return "\n".join(lines)
+
+
+def score_take(
+    ref_pitches: np.ndarray,
+    ref_whens: np.ndarray,
+    take_pitches: np.ndarray,
+    take_whens: np.ndarray,
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> TakeScore:
+    # Both as toggle lists with pitches already on the same keys. Finds the part
+    # of the song the take plays and follows its tempo (and any pauses) with
+    # DTW, tightens that with the running median of a couple of wider matching
+    # passes, then matches within `tolerance`. Only the reference onsets that
+    # land within the take are scored.
+    started = time.perf_counter()
+    ref_pitches, ref_whens = onsets(np.asarray(ref_pitches, dtype=np.int64), np.asarray(ref_whens, dtype=np.float64))
+    take_pitches, take_whens = onsets(np.asarray(take_pitches, dtype=np.int64), np.asarray(take_whens, dtype=np.float64))
+    shift = np.zeros(len(ref_whens))
+    if len(ref_whens) and len(take_whens):
+        shift = align(ref_pitches, ref_whens, take_pitches, take_whens)
+    for window in WARP_WINDOWS:
+        matched = match_onsets(ref_pitches, ref_whens + shift, take_pitches, take_whens, window)
+        hit = matched >= 0
+        if hit.any():
+            shift = np.interp(ref_whens, ref_whens[hit], estimate_warp(ref_whens[hit], take_whens[matched[hit]] - ref_whens[hit]))
+    if len(take_whens):
+        expected_at = ref_whens + shift
+        inside = (expected_at >= take_whens[0] - tolerance) & (expected_at <= take_whens[-1] + tolerance)
+        ref_pitches, ref_whens, shift = ref_pitches[inside], ref_whens[inside], shift[inside]
+    matched = match_onsets(ref_pitches, ref_whens + shift, take_pitches, take_whens, tolerance)
+    offset = float(shift[0]) if len(shift) else 0.0
+    covered = (float(ref_whens[0]), float(ref_whens[-1])) if len(ref_whens) else (0.0, 0.0)
+    return TakeScore(
+        ref_pitches, ref_whens, take_pitches, take_whens, matched, ref_whens + shift, offset, covered,
+        elapsed=time.perf_counter() - started,
+    )
+
+
+def reference_arrays(fname: str, transpose: T.Optional[int] = None) -> T.Tuple[np.ndarray, np.ndarray]:
+    # A song as it lands on the overlay's keys: transposed, then folded into range
+    from render_notes import fold_into_range
+
+    song = load_song(fname)
+    pitches, whens = song.to_arrays()
+    return fold_into_range(pitches + (song.transpose if transpose is None else transpose)), whens
+
+
+def score_recording(
+    take_fname: str,
+    song_fname: str,
+    transpose: T.Optional[int] = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> TakeScore:
+    from render_notes import keyboard_names_by_pitch
+
+    ref_pitches, ref_whens = reference_arrays(song_fname, transpose)
+    take_pitches, take_whens = notes_to_arrays(read_midi_file(take_fname))
+    score = score_take(ref_pitches, ref_whens, take_pitches, take_whens, tolerance)
+    score.names = keyboard_names_by_pitch()
+    return score
+
+
+def main():
+    import argparse
+    from read_notes import RECORDINGS
+
+    parser = argparse.ArgumentParser(description="Score a recorded take against the song it was playing")
+    parser.add_argument("take", help="A recording, as a path or a name in recordings/")
+    parser.add_argument("song", help="Path to the reference .mid / .mscz / .gmsong file")
+    parser.add_argument("--transpose", type=int, default=None, help="Defaults to the song's automatic transpose")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Seconds a press can be off and still count")
+    args = parser.parse_args()
+    take = args.take if os.path.exists(args.take) else os.path.join(RECORDINGS, args.take)
+    print(score_recording(take, args.song, args.transpose, args.tolerance).summary())
+
+
+if __name__ == "__main__":
+    main()
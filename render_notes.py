@@ -1,20 +1,35 @@
+from startup_timing import STARTUP
+
+import os
 import threading
-import win32api
-import win32con
-import win32gui
+from collections import deque
+from concurrent.futures import Future
 
 import typing as T
 import pygame
-import pygame.midi
 import numpy as np
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 import colorsys
 import time
-pygame.init()
-pygame.midi.init()
 
-from read_notes import autotranspose, read_midi_file, discover_files, dump_midi_file
-from interception_py.interception_sender import InterceptionSender
+from read_notes import COMPILED_EXT, CompiledSong, LibraryIndex, dump_midi_file, load_song, notes_to_arrays
+from midi_io import MIDIInputReader, MIDIOutputWorker
+from keyboard_state import KeyboardState
+from timeline import Timeline
+from playlist import Playlist
+from stroke_governor import StrokeGovernor, chord_priorities
+from recording_journal import RecordingJournal, finalize_journal, read_journal
+from recording_scorer import TakeScore, score_take
+from emission_stats import EmissionTag, EmissionTracker
+from frame_profiler import FrameProfiler
+from library_watcher import MODIFIED, LibraryWatcher
+
+if T.TYPE_CHECKING:
+    # Both pull in heavy modules (multiprocessing, asyncio), imported when their setting is on
+    from emission_process import EmitterProcess
+    from control_server import ControlServer
+
+STARTUP.add("imports", STARTUP.started_at)
 
 TRANSPARENT_BACKGROUND = (255, 0, 128)
 KEY_COLOR = (240, 240, 240)
@@ -39,9 +54,19 @@ KEYBOARD_LETTERS_WITH_SKIPS = [
 ]
 N_PLAYABLE_OCTAVES = 3
 N_NOTES_PER_ROW = 7
+N_MIDI_PITCHES = 128
 MAKE_TRANSPARENT = True
+PLAYLIST_LEAD = 2.0
+SEEK_STEP = 15.0
+TIMESCALE_STEP = 0.1
+MIN_TIMESCALE = 0.1
 
 def make_window_transparent():
+    # Windows only
+    import win32api
+    import win32con
+    import win32gui
+
     # Create layered window
     NOSIZE = 1
     NOMOVE = 2
@@ -66,6 +91,24 @@ def midi_pitch_to_name(pitch: int) -> T.Optional[str]:
     else:
         return the_name
 
+def fold_into_range(pitches: np.ndarray) -> np.ndarray:
+    # Whole octaves up or down until every pitch is between LOWEST_NOTE and HIGHEST_NOTE
+    above = np.maximum(pitches - HIGHEST_NOTE, 0)
+    below = np.maximum(LOWEST_NOTE - pitches, 0)
+    pitches = pitches - OCTAVE_SEMITONES * (-(-above // OCTAVE_SEMITONES))
+    return pitches + OCTAVE_SEMITONES * (-(-below // OCTAVE_SEMITONES))
+
+
+def keyboard_names_by_pitch() -> T.List[T.Optional[str]]:
+    # Like midi_pitch_to_keyboard for every MIDI pitch, with None for black keys
+    names: T.List[T.Optional[str]] = [None] * N_MIDI_PITCHES
+    for offset in range(N_PLAYABLE_OCTAVES * OCTAVE_SEMITONES):
+        name = KEYBOARD_LETTERS_WITH_SKIPS[offset // OCTAVE_SEMITONES][offset % OCTAVE_SEMITONES]
+        if name != "_":
+            names[LOWEST_NOTE + offset] = name
+    return names
+
+
 def midi_pitch_to_keyboard(pitch: int) -> T.Optional[str]:
     n_notes = sum(len(l) for l in KEYBOARD_LETTERS_WITH_SKIPS)
     offset = pitch - LOWEST_NOTE
@@ -108,15 +151,32 @@ def get_note_color(
         bright = colorsys.hsv_to_rgb(norm_offset, 0.7, 1.0)
         return tuple(map(rgb_norm_to_rgb, [upcoming, dim, bright]))
 
+def _state_property(column: str) -> property:
+    def getter(self: "KeySquare") -> bool:
+        return bool(getattr(self.state, column)[self.ix])
+
+    def setter(self: "KeySquare", value: bool):
+        getattr(self.state, column)[self.ix] = value
+
+    return property(getter, setter)
+
+
 class KeySquare:
-    def __init__(self, game: "MIDIRenderer", midi_key: int, norm_xpos: float, norm_ypos: float):
+    is_really_down = _state_property("is_really_down")
+    key_is_pressed = _state_property("key_is_pressed")
+    should_be_down = _state_property("should_be_down")
+    note_on = _state_property("note_on")
+
+    def __init__(self, game: "MIDIRenderer", midi_key: int, norm_xpos: float, norm_ypos: float, ix: int):
         self.game: "MIDIRenderer" = game
+        self.state: KeyboardState = game.key_state
+        self.ix: int = ix
         self.midi_key: int = midi_key
         key_name = midi_pitch_to_keyboard(self.midi_key)
         assert key_name is not None, f"Bad key {self.midi_key}"
         self.keyboard_key_name: str = key_name
         self.keyboard_key: int = pygame.key.key_code(self.keyboard_key_name)
-        self.when: T.List[float] = []
+        self.when: Timeline = Timeline()
         self.norm_xpos: float = norm_xpos
         self.norm_ypos: float = norm_ypos
         colors = get_note_color(self.midi_key)
@@ -130,11 +190,27 @@ class KeySquare:
         assert m_pitch is not None, "no sharps or flats"
         self._pitch_name = m_pitch
 
-        self.is_really_down: bool = False
-        self.key_is_pressed: bool = False
-        self.should_be_down: bool = False
-        self.note_on: bool = False
+        self.is_really_down = False
+        self.key_is_pressed = False
+        self.should_be_down = False
+        self.note_on = False
+
+        self.when_ix = 0
+
+    @property
+    def when_ix(self) -> int:
+        return int(self.state.when_ix[self.ix])
 
+    @when_ix.setter
+    def when_ix(self, value: int):
+        self.state.when_ix[self.ix] = value
+        self.sync_timeline()
+
+    def sync_timeline(self):
+        self.state.sync_timeline(self.ix, self.when)
+
+    def clear_when(self):
+        self.when.clear()
         self.when_ix = 0
 
     def peek(self) -> T.Optional[float]:
@@ -153,15 +229,15 @@ class KeySquare:
 
 
     def update(self, now: float) -> None:
-        n_toggles = 0
+        scheduled: T.List[float] = []
         while (next_time := self.peek()) is not None and next_time <= now:
             self.pop()
-            n_toggles += 1
+            scheduled.append(next_time)
         
-        for n in range(n_toggles):
+        for when in scheduled:
             self.fake_toggle()
             if self.game.recording_plays:
-                self.real_toggle()
+                self.real_toggle(tag=self.game.emission_tag(when))
 
     def backout_before(self, now: float) -> None:
         original_when_ix = self.when_ix
@@ -169,11 +245,11 @@ class KeySquare:
 
         # Find the point where the NEXT action is in the future, and the PREVIOUS
         # action is in the past
-        new_when_ix = max(0, new_when_ix)
+        new_when_ix = max(self.when.first_index, new_when_ix)
         while True:
             prev_idx = new_when_ix - 1
             
-            if prev_idx < 0 or prev_idx >= len(self.when):
+            if prev_idx < self.when.first_index or prev_idx >= len(self.when):
                 prev_in_past = True
             else:
                 prev_in_past = (self.when[prev_idx] <= now)
@@ -182,7 +258,7 @@ class KeySquare:
                 new_when_ix -= 1
                 continue
         
-            if new_when_ix < 0 or new_when_ix >= len(self.when):
+            if new_when_ix < self.when.first_index or new_when_ix >= len(self.when):
                 next_in_future = True
             else:
                 next_in_future = (self.when[new_when_ix] > now)
@@ -246,7 +322,7 @@ class KeySquare:
         drawing_is_stop = self.is_really_down
         prev_height = top
         is_first = True
-        while drawing_block >= 0 and drawing_block < len(self.when):
+        while drawing_block >= self.when.first_index and drawing_block < len(self.when):
             drawing_at = self.when[drawing_block]
             since_then = now - drawing_at
             assert since_then >= 0, "Shouldn't be in here"
@@ -296,33 +372,41 @@ class KeySquare:
         left, top = self.game.norm_pos_to_abs((self.norm_xpos, self.norm_ypos), (txt_width, txt_height))
         disp.blit(rendered_text, pygame.Rect(left, top, txt_width, txt_height), None)
 
-    def real_down(self, was_keypress: bool = False):
+    def real_down(self, was_keypress: bool = False, tag: T.Optional[EmissionTag] = None):
         if was_keypress:
             self.key_is_pressed = True
         if not self.is_really_down:
             self.is_really_down = True
             if self.game.play_sounds:
-                self.game.out_sounds.note_on(self.midi_key, 127, 0)
+                self.game.midi_out.note_on(self.midi_key, 127, 0, tag)
                 self.note_on = True
             if self.game.macro_output and not was_keypress and not self.game.window_focused:
                 assert self.game.ignore_keypresses, "Refuse!"
                 self.key_is_pressed = True
-                self.game.macro.keyDown(self.keyboard_key_name.lower())
-                self.game.macro.keyUp(self.keyboard_key_name.lower())
+                if self.game.emitter is None:
+                    # Sent together with everything else that went down this frame
+                    self.game.pending_taps.append((self.keyboard_key_name.lower(), self.midi_key))
+                    if tag is not None:
+                        self.game.emission.key_scheduled(self.keyboard_key_name.lower(), tag)
+                elif tag is None:
+                    # Not from a timeline, so the emission process can't have it yet
+                    self.game.pending_taps.append((self.keyboard_key_name.lower(), self.midi_key))
             if self.game.recording_mode:
                 assert self.when_ix == len(self.when), "Still have stuff to play"
                 self.when.append(self.game.now)
                 self.when_ix += 1
+                if self.game.journal is not None:
+                    self.game.journal.append(self.midi_key, self.game.now)
                 
 
     
-    def real_up(self, was_keypress: bool = False):
+    def real_up(self, was_keypress: bool = False, tag: T.Optional[EmissionTag] = None):
         if was_keypress:
             self.key_is_pressed = False
         if self.is_really_down:
             self.is_really_down = False
             if self.note_on:
-                self.game.out_sounds.note_off(self.midi_key, 127, 0)
+                self.game.midi_out.note_off(self.midi_key, 127, 0, tag)
             
             if self.game.macro_output and not was_keypress and self.key_is_pressed:
                 assert self.game.ignore_keypresses, "Refuse!"
@@ -332,16 +416,14 @@ class KeySquare:
                 assert self.when_ix == len(self.when), "Still have stuff to play"
                 self.when.append(self.game.now)
                 self.when_ix += 1
+                if self.game.journal is not None:
+                    self.game.journal.append(self.midi_key, self.game.now)
 
-    def real_toggle(self, was_keypress: bool = False):
+    def real_toggle(self, was_keypress: bool = False, tag: T.Optional[EmissionTag] = None):
         if self.is_really_down:
-            self.real_up(was_keypress)
+            self.real_up(was_keypress, tag)
         else:
-            self.real_down(was_keypress)
-
-    def okay_to_progress(self) -> bool:
-        # It's okay to leave things on, but not to have them off
-        return (not self.should_be_down) or (self.should_be_down and self.is_really_down)
+            self.real_down(was_keypress, tag)
 
     def dump(self) -> T.List[T.Tuple[int, float]]:
         return [(self.midi_key, when) for when in self.when]
@@ -361,6 +443,21 @@ class GameSettings:
     paused: bool = field(default=True) # Do we start paused?
     progression_mode: bool = field(default=False)
     transpose_amount: int = field(default=0)
+    materialize_window: float = field(default=120.0) # Seconds of upcoming notes kept in the key timelines
+    chord_tolerance: float = field(default=0.0) # Onsets closer than this (seconds) play as one chord
+    # Macro keystroke limits, none by default; the game's own limits are around 0.02 / 50 / 0.03
+    min_press_duration: float = field(default=0.0) # Seconds each macro key is held
+    max_strokes_per_sec: float = field(default=float("inf"))
+    min_repress_gap: float = field(default=0.0) # Seconds between releasing a macro key and pressing it again
+    show_latency: bool = field(default=False) # Emission lateness readout in the corner of the overlay
+    show_profiler: bool = field(default=False) # Rolling per-phase frame times, F3 toggles
+    watch_library: bool = field(default=True) # Pick up new, removed and edited songs while running
+    reload_edited_songs: bool = field(default=True) # Re-splice a queued song when its file changes
+    emission_process: bool = field(default=False) # Send macro keystrokes from their own process, scheduled ahead
+    emission_lookahead: float = field(default=0.25) # Seconds of song handed to the emission process in advance
+    control_server: bool = field(default=False) # Accept commands over a localhost socket, see control_client.py
+    control_port: T.Optional[int] = field(default=None) # None uses control_server.DEFAULT_PORT
+    reference_song: str = field(default="") # Library name or file a take is scored against when it's saved
 
     def __post_init__(self):
         if self.macro_output:
@@ -368,10 +465,45 @@ class GameSettings:
 
 
 
+class SplicedSong(T.NamedTuple):
+    offset: float
+    name: str
+    fname: str
+    song: CompiledSong
+
+
+@dataclass
+class PendingSong:
+    # The parts of a spliced song that haven't been handed to the keys yet
+    offset: float
+    runs: T.List[T.Tuple[KeySquare, np.ndarray]]
+    cursors: T.List[int]
+
+
+def _settings_property(name: str) -> property:
+    def getter(self: "MIDIRenderer") -> T.Any:
+        return getattr(self.settings, name)
+
+    def setter(self: "MIDIRenderer", value: T.Any):
+        setattr(self.settings, name, value)
+
+    return property(getter, setter)
+
+
 class MIDIRenderer():
-    def __init__(self, preset: T.Optional[GameSettings] = None):
+    def __init__(
+        self,
+        preset: T.Optional[GameSettings] = None,
+        clock: T.Callable[[], float] = time.time,
+        event_source: T.Callable[[], T.List[pygame.event.Event]] = pygame.event.get,
+        macro: T.Any = None,
+    ):
         # Settings
         self.settings = preset or GameSettings()
+        self.clock = clock
+        self.event_source = event_source
+        # Everything else (fonts, MIDI ports, the library scan) waits until it's used
+        pygame.display.init()
         
         # Properties - these are determined / adjusted
         self.now: float = 0.0
@@ -379,24 +511,64 @@ class MIDIRenderer():
         self.is_done = False
         self.is_staggered = True
         self.recording_mode = False
+        self.journal: T.Optional[RecordingJournal] = None
         self.window_size: T.Tuple[int, int] = pygame.display.get_window_size()
         self.mouse_pos: T.Tuple[int, int] = pygame.mouse.get_pos()
         self.keys: T.Dict[int, KeySquare] = {}
+        self.key_state = KeyboardState(N_PLAYABLE_OCTAVES * N_NOTES_PER_ROW)
+        self.keys_by_index: T.List[KeySquare] = []
+        self.keys_by_keycode: T.Dict[int, KeySquare] = {}
+        self.keys_by_pitch: T.List[T.Optional[KeySquare]] = [None] * N_MIDI_PITCHES
         self.last_update: T.Optional[float] = None
         
         self.window_active = True
         self.window_focused = True
-        self.macro = InterceptionSender()
-        self.known_files: T.Dict[str, str] = discover_files()
-        out_port = pygame.midi.get_default_output_id()
-        in_port = pygame.midi.get_default_input_id()
-        self.in_sounds: T.Optional[pygame.midi.Input] = None
-        if in_port != -1:
-            self.in_sounds = pygame.midi.Input(in_port)
-            print("Now listening to", pygame.midi.get_device_info(in_port))
-        self.out_sounds = pygame.midi.Output(out_port, 0)
-
-        self.font = pygame.font.Font(pygame.font.get_default_font(), 32)
+        self.macro: T.Any = macro
+        self.emitter: T.Optional["EmitterProcess"] = None
+        if self.macro is None and self.macro_output and self.emission_process:
+            # The emission process makes its own sender
+            from emission_process import EmitterProcess
+            self.emitter = EmitterProcess(self.stroke_limits(), lookahead=self.emission_lookahead)
+        elif self.macro is None and self.macro_output:
+            # Needs the interception driver, so Windows only
+            from interception_py.interception_sender import InterceptionSender
+            self.macro = InterceptionSender()
+        self._library: T.Optional[LibraryIndex] = None
+        self._known_files: T.Optional[T.Dict[str, str]] = None
+        self.playlist = Playlist()
+        self.pending_songs: T.List[PendingSong] = []
+        # Every spliced song's runs, kept so a seek back past what was forgotten can rebuild
+        self.song_runs: T.List[PendingSong] = []
+        self._forgotten_until = -np.inf
+        self.spliced_songs: T.List[SplicedSong] = []
+        self._pending_reloads: T.Dict[str, T.Tuple[str, "Future[CompiledSong]"]] = {}
+        self.watcher: T.Optional[LibraryWatcher] = None
+        self.server: T.Optional["ControlServer"] = None
+        self.pending_taps: T.List[T.Tuple[str, int]] = []
+        self.commands: T.Deque[T.Callable[[], None]] = deque()
+        self._restore_play_sounds: T.Optional[bool] = None
+        self.hotkeys: T.Dict[int, T.Callable[[], None]] = {
+            pygame.K_RIGHT: lambda: self.seek(self.now + SEEK_STEP),
+            pygame.K_LEFT: lambda: self.seek(self.now - SEEK_STEP),
+            pygame.K_UP: lambda: self.set_timescale(self.timescale + TIMESCALE_STEP),
+            pygame.K_DOWN: lambda: self.set_timescale(self.timescale - TIMESCALE_STEP),
+            pygame.K_1: self.toggle_pause,
+            pygame.K_2: self.toggle_layout,
+            pygame.K_3: self.toggle_progression,
+            pygame.K_p: self.toggle_pause,
+            pygame.K_F3: self.toggle_profiler,
+            pygame.K_F4: self.toggle_profile_capture,
+        }
+        self.emission = EmissionTracker(clock=self.clock)
+        self.profiler = FrameProfiler()
+        self.governor = StrokeGovernor(self.macro, clock=self.clock, tracker=self.emission, **self.stroke_limits())
+        # Ports are opened by open_midi_ports(); until then notes go nowhere
+        self.in_sounds: T.Any = None
+        self.midi_reader: T.Optional[MIDIInputReader] = None
+        self.out_sounds: T.Any = None
+        self.midi_out = MIDIOutputWorker(None, tracker=self.emission)
+        self._font: T.Optional[pygame.font.Font] = None
+        self._small_font: T.Optional[pygame.font.Font] = None
         
         if self.paused:
             pygame.display.set_caption("PAUSED")
@@ -405,17 +577,56 @@ class MIDIRenderer():
 
         self._setup_keys()
 
-    def __getattr__(self, attrname) -> T.Any:
-        try:
-            return super().__getattr__(attrname)
-        except AttributeError:
-            return getattr(self.settings, attrname)
-    
-    def __setattr__(self, attrname, attrval) -> T.Any:
-        if attrname != "settings" and attrname in dir(self.settings):
-            return setattr(self.settings, attrname, attrval)
-        else:
-            return super().__setattr__(attrname, attrval)
+    @property
+    def library(self) -> LibraryIndex:
+        if self._library is None:
+            with STARTUP.phase("library scan"):
+                self._library = LibraryIndex.scan()
+            for name, candidates in self._library.ambiguous().items():
+                print(f"Ambiguous song name {name}: {', '.join(candidates)}")
+            self._known_files = None
+        return self._library
+
+    @property
+    def known_files(self) -> T.Dict[str, str]:
+        # Rebuilt only when the library changes
+        if self._known_files is None:
+            self._known_files = self.library.files()
+        return self._known_files
+
+    def add_library_file(self, name: str, fname: str):
+        self.library.add(name, fname)
+        self._known_files = None
+
+    @property
+    def font(self) -> pygame.font.Font:
+        if self._font is None:
+            with STARTUP.phase("fonts"):
+                pygame.font.init()
+                self._font = pygame.font.Font(pygame.font.get_default_font(), 32)
+                self._small_font = pygame.font.Font(pygame.font.get_default_font(), 14)
+        return self._font
+
+    @property
+    def small_font(self) -> pygame.font.Font:
+        if self._small_font is None:
+            self.font
+        return self._small_font
+
+    def open_midi_ports(self):
+        with STARTUP.phase("midi ports"):
+            import pygame.midi
+            pygame.midi.init()
+            out_port = pygame.midi.get_default_output_id()
+            in_port = pygame.midi.get_default_input_id()
+            if in_port != -1 and self.in_sounds is None:
+                self.in_sounds = pygame.midi.Input(in_port)
+                self.midi_reader = MIDIInputReader(self.in_sounds)
+                print("Now listening to", pygame.midi.get_device_info(in_port))
+            if out_port != -1 and self.out_sounds is None:
+                self.out_sounds = pygame.midi.Output(out_port, 0)
+                # The worker isn't running yet, so it's safe to hand it the port
+                self.midi_out.device = self.out_sounds
 
     def _setup_keys(self):
         left_norm = 0.10
@@ -440,6 +651,7 @@ class MIDIRenderer():
                             pitch,
                             xpos,
                             ypos,
+                            len(self.keys),
                         )
                     else:
                         self.keys[pitch].norm_xpos = xpos
@@ -447,6 +659,19 @@ class MIDIRenderer():
                     real_col += 1
                 pitch += 1
         self.is_staggered = True
+        self._index_keys()
+
+    def _index_keys(self):
+        self.keys_by_index = sorted(self.keys.values(), key=lambda k: k.ix)
+        self.keys_by_keycode = {k.keyboard_key: k for k in self.keys.values()}
+        self.keys_by_pitch = [self.keys.get(pitch, None) for pitch in range(N_MIDI_PITCHES)]
+
+    def key_for_midi_input(self, pitch: int) -> T.Optional[KeySquare]:
+        tr = self._transform_pitch(pitch)
+        if 0 <= tr < N_MIDI_PITCHES:
+            return self.keys_by_pitch[tr]
+        else:
+            return None
     
     def dump(self) -> T.List[T.Tuple[int, float]]:
         full_dump: T.List[T.Tuple[int, float]] = []
@@ -454,17 +679,47 @@ class MIDIRenderer():
             full_dump.extend(self.keys[k_id].dump())
         return full_dump
 
+    def start_recording(self) -> None:
+        self.recording_mode = True
+        self.now = 0.0
+        self.timescale = 1.0
+        self.journal = RecordingJournal()
+        self.journal.start()
+        print("Journaling take to", self.journal.fname)
+
     def save(self) -> None:
-        dump_midi_file(self.dump())
+        if self.journal is not None:
+            self.journal.close()
+            pitches, whens = read_journal(self.journal.fname)
+            print("Saved", finalize_journal(self.journal.fname))
+            self.journal = None
+        else:
+            take = self.dump()
+            dump_midi_file(take)
+            pitches, whens = notes_to_arrays(take)
+        if self.reference_song:
+            self.score_take(pitches, whens)
+
+    def score_take(self, pitches: np.ndarray, whens: np.ndarray) -> T.Optional[TakeScore]:
+        # Against reference_song, laid onto the keys the same way it would be played
+        try:
+            fname = self.reference_song if os.path.exists(self.reference_song) else self.library.resolve(self.reference_song)
+        except KeyError as e:
+            print(f"Can't score the take: {e}")
+            return None
+        song = load_song(fname)
+        ref_pitches, ref_whens = song.to_arrays()
+        score = score_take(self._transform_pitches(ref_pitches + song.transpose - self.transpose_amount), ref_whens, pitches, whens)
+        score.names = keyboard_names_by_pitch()
+        print(f"Take vs {os.path.basename(fname)}:")
+        print(score.summary())
+        return score
 
     def reviewing_recording(self) -> bool:
         if not self.recording_mode:
             return False
         else:
-            for k_id in self.keys:
-                if self.keys[k_id].when_ix != len(self.keys[k_id].when):
-                    return True
-            return False
+            return self.key_state.any_reviewing()
 
     def _rearrange(self):
         left_norm = 0.10
@@ -486,71 +741,295 @@ class MIDIRenderer():
                 transposed += OCTAVE_SEMITONES
         return transposed
 
+    def _transform_pitches(self, pitches: np.ndarray) -> np.ndarray:
+        transposed = pitches + self.transpose_amount
+        if self.keep_in_bounds:
+            transposed = fold_into_range(transposed)
+        return transposed
+
+    def _accept_song(self, name: str, song: CompiledSong, min_confidence: float) -> bool:
+        if song.score < min_confidence:
+            print(f"Too many black notes: {name}: {int(song.score*100)}% white")
+            return False
+        print(f"automatically transposing by {song.transpose}")
+        return True
+
+    def _clear_timelines(self):
+        self.pending_songs.clear()
+        self.song_runs.clear()
+        self._forgotten_until = -np.inf
+        self.spliced_songs.clear()
+        for k_id in self.keys:
+            self.keys[k_id].clear_when()
+            self.keys[k_id].real_up()
+        self.emission.clear_songs()
+        self._timeline_jumped()
+        self.enqueue_at = 2.0
+
+    def _splice_song(self, name: str, song: CompiledSong, offset: float, fname: str = ""):
+        self.spliced_songs.append(SplicedSong(offset, name, os.path.abspath(fname) if fname else "", song))
+        tr_diff = song.transpose - self.transpose_amount
+
+        # Several source pitches can land on one key once folded into range
+        source_pitches = song.pitches()
+        targets = self._transform_pitches(source_pitches + tr_diff)
+        ngood = 0
+        runs: T.List[T.Tuple[KeySquare, np.ndarray]] = []
+        for target in np.unique(targets):
+            the_key = self.keys.get(int(target), None)
+            if the_key is None:
+                continue
+            key_runs = [song.timeline(int(p)) for p in source_pitches[targets == target]]
+            if len(key_runs) == 1:
+                # Zero-copy: the key reads straight from the song's array
+                merged = key_runs[0]
+            else:
+                merged = np.sort(np.concatenate(key_runs), kind="stable")
+            runs.append((the_key, merged))
+            ngood += len(merged)
+        # Only the next materialize_window seconds go into the key timelines now
+        self.pending_songs.append(PendingSong(offset, runs, [0] * len(runs)))
+        self.song_runs.append(PendingSong(offset, runs, [0] * len(runs)))
+        self.emission.add_song(name, offset)
+        self._materialize_until(self.now + self.materialize_window)
+        nbad = song.n_notes - ngood
+        self.enqueue_at = max(self.enqueue_at, offset + song.duration)
+        print(f"{name}: {ngood} / {ngood + nbad} :: {int(ngood / (ngood+nbad) * 100)}%")
+
+    def _materialize_until(self, horizon: float):
+        while self.pending_songs:
+            pending = self.pending_songs[0]
+            if pending.offset > horizon:
+                break
+            done = True
+            for i, (the_key, run) in enumerate(pending.runs):
+                cursor = pending.cursors[i]
+                upto = int(np.searchsorted(run, horizon - pending.offset, side="right"))
+                if upto > cursor:
+                    the_key.when.add_segment(run[cursor:upto], pending.offset)
+                    the_key.sync_timeline()
+                    pending.cursors[i] = upto
+                done = done and upto == len(run)
+            if not done:
+                # Later songs start after this one ends
+                break
+            self.pending_songs.pop(0)
+
+    def _forget_before(self, when: float):
+        for k_id in self.keys:
+            the_key = self.keys[k_id]
+            if the_key.when.drop_before(when, the_key.when_ix):
+                self._forgotten_until = max(self._forgotten_until, when)
+
+    def _rematerialize(self, now: float):
+        # Seeking back past what _forget_before dropped: rebuild the timelines
+        # from the songs' runs, a window before `now` onwards
+        for k_id in self.keys:
+            self.keys[k_id].clear_when()
+            self.keys[k_id].real_up()
+            self.keys[k_id].should_be_down = False
+        self.pending_songs = []
+        for each in self.song_runs:
+            cursors = [int(np.searchsorted(run, now - self.materialize_window - each.offset)) for (_, run) in each.runs]
+            # From a press, so every key starts out up
+            self.pending_songs.append(PendingSong(each.offset, each.runs, [c - c % 2 for c in cursors]))
+        self._forgotten_until = -np.inf
+        self._materialize_until(now + self.materialize_window)
+        for k_id in self.keys:
+            self.keys[k_id].backout_before(now)
+
     def enqueue_file(self, name: str, clear_existing: bool = False, min_confidence: float = 0):
         # Throw error is OK
         name = name.lower()
-        fn = self.known_files[name]
+        fn = self.library.resolve(name)
         self.now = 0
-        notes = read_midi_file(fn)
-        tr, tr_score = autotranspose(notes)
-        if tr_score < min_confidence:
-            print(f"Too many black notes: {name}: {int(tr_score*100)}% white")
+        self._timeline_jumped()
+        song = load_song(fn, self.chord_tolerance)
+        if not self._accept_song(name, song, min_confidence):
             return
-        print(f"automatically transposing by {tr}")
-        tr_diff = tr - self.transpose_amount
 
         if clear_existing:
+            self._clear_timelines()
+
+        self._splice_song(name, song, self.enqueue_at, fn)
+
+    def queue_song(self, name: str, min_confidence: float = 0, clear_existing: bool = False):
+        # Like enqueue_file, but loads in the background and splices in once
+        # ready, without moving now
+        name = name.lower()
+        fname = self.library.resolve(name)
+        if clear_existing:
+            self.playlist.clear()
+            self._clear_timelines()
+        self.playlist.submit(name, fname, min_confidence, self.chord_tolerance)
+
+    def _splice_ready_songs(self):
+        for (queued, song) in self.playlist.pop_ready():
+            if song is None or not self._accept_song(queued.name, song, queued.min_confidence):
+                continue
+            # If we've already played past the end, start a little ahead of now
+            self._splice_song(queued.name, song, max(self.enqueue_at, self.now + PLAYLIST_LEAD), queued.fname)
+
+    def reload_songs(self, replacements: T.Dict[str, T.Tuple[str, CompiledSong]]):
+        # Rebuilds the timelines from the spliced songs, with the ones in
+        # `replacements` (old file -> (new file, its song)) swapped, and picks up
+        # where we were. Everything is already loaded, so nothing can fail halfway.
+        now = self.now
+        songs = list(self.spliced_songs)
+        self._clear_timelines()
+        for each in songs:
+            fname, song = replacements.get(each.fname, (each.fname, each.song))
+            self._splice_song(each.name, song, each.offset, fname)
+        prev_play = self.play_sounds
+        self.play_sounds = False
+        for k_id in self.keys:
+            self.keys[k_id].should_be_down = False
+            self.keys[k_id].backout_before(now)
+        self.play_sounds = prev_play
+        self.now = now
+
+    def _apply_library_changes(self):
+        changes = self.watcher.apply(self._library)
+        if changes:
+            self._known_files = None
+        if not changes or not self.reload_edited_songs:
+            return
+        replacements: T.Dict[str, str] = {}
+        for (kind, path) in changes:
+            if kind != MODIFIED:
+                continue
+            name = os.path.splitext(os.path.basename(path))[0].lower()
+            for each in self.spliced_songs:
+                # Either the file itself, or the source of a compiled copy that's now stale
+                stale = each.fname.endswith(COMPILED_EXT) and each.fname not in self.library.candidates(name)
+                if each.fname == path or (each.name == name and stale):
+                    replacements[each.fname] = path
+        for (old, path) in replacements.items():
+            print(f"Reloading {os.path.basename(path)}")
+            self._pending_reloads[old] = (path, self.playlist.load(path, self.chord_tolerance))
+
+    def _reload_ready_songs(self):
+        # Waits until every edited song has parsed, then swaps them in together;
+        # one that failed keeps playing the old version
+        if not self._pending_reloads or not all(f.done() for (_, f) in self._pending_reloads.values()):
+            return
+        replacements: T.Dict[str, T.Tuple[str, CompiledSong]] = {}
+        for (old, (path, future)) in self._pending_reloads.items():
+            try:
+                replacements[old] = (path, future.result())
+            except Exception as e:
+                print(f"Couldn't reload {os.path.basename(path)}: {e!r}")
+        self._pending_reloads.clear()
+        if replacements:
+            self.reload_songs(replacements)
+
+
+    def _mute_this_frame(self):
+        if self._restore_play_sounds is None:
+            self._restore_play_sounds = self.play_sounds
+        self.play_sounds = False
+
+    def seek(self, to: float):
+        # Jumps to song time `to`, without sounding everything in between
+        backwards = to < self.now
+        self.now = max(0.0, to)
+        self._timeline_jumped()
+        self._mute_this_frame()
+        if backwards and self.now < self._forgotten_until and not self.recording_mode:
+            self._rematerialize(self.now)
+        elif backwards:
             for k_id in self.keys:
-                self.keys[k_id].when.clear()
-                self.keys[k_id].real_up()
-            self.enqueue_at = 2.0
+                self.keys[k_id].backout_before(self.now)
 
-        
-        sorted_ww = sorted(notes, key=lambda ww: ww[1], reverse=False)
-        
-        ngood = 0
-        nbad = 0
-        offset = self.enqueue_at
-        for (what, when) in sorted_ww:
-            what = self._transform_pitch(what + tr_diff)
-            when = when + offset
-            the_key = self.keys.get(what, None)
-            if the_key is not None:
-                the_key.when.append(when)
-                ngood += 1
-            else:
-                nbad += 1
-            self.enqueue_at = max(self.enqueue_at, when)
-        print(f"{name}: {ngood} / {ngood + nbad} :: {int(ngood / (ngood+nbad) * 100)}%")
+    def set_timescale(self, timescale: float):
+        self.timescale = max(MIN_TIMESCALE, timescale)
+
+    def set_paused(self, paused: bool):
+        self.paused = paused
+        pygame.display.set_caption("PAUSED" if paused else "PLAYING")
+
+    def toggle_pause(self):
+        self.set_paused(not self.paused)
 
+    def toggle_layout(self):
+        if self.is_staggered:
+            self._rearrange()
+        else:
+            self._setup_keys()
+
+    def toggle_progression(self):
+        self.progression_mode = not self.progression_mode
+
+    def toggle_profiler(self):
+        self.show_profiler = not self.show_profiler
+
+    def toggle_profile_capture(self):
+        written = self.profiler.toggle_capture()
+        if written is not None:
+            print(f"Wrote profile to {written}")
+        else:
+            print("Profiling...")
+
+    def set_transpose(self, amount: int):
+        # Takes effect on everything already queued, from where we are now
+        self.transpose_amount = amount
+        self.reload_songs({})
+
+    def status(self) -> T.Dict[str, T.Any]:
+        return {
+            "now": self.now,
+            "paused": self.paused,
+            "timescale": self.timescale,
+            "transpose": self.transpose_amount,
+            "songs": [{"name": each.name, "offset": each.offset} for each in self.spliced_songs],
+            "ends_at": self.enqueue_at,
+            "queued": len(self.playlist),
+            "recording": self.recording_mode,
+        }
+
+    def _timeline_jumped(self):
+        # Whatever the emission process was given is no longer where we are
+        if self.emitter is not None:
+            self.emitter.reset()
+
+    def emission_tag(self, scheduled: float) -> EmissionTag:
+        return self.emission.tag(scheduled, self.now, self.last_update if self.last_update is not None else self.clock(), self.timescale)
 
     def okay_to_progress(self) -> bool:
         if self.recording_plays:
             return True
         else:
-            for k_id in self.keys:
-                if not self.keys[k_id].okay_to_progress():
-                    return False
-            
-            return True
+            return self.key_state.okay_to_progress()
+
+    def stroke_limits(self) -> T.Dict[str, float]:
+        # Read every frame, so changing the settings takes effect straight away
+        return dict(
+            min_press_duration=self.min_press_duration,
+            max_strokes_per_sec=self.max_strokes_per_sec,
+            min_repress_gap=self.min_repress_gap,
+        )
+
+    def _poll_window(self):
+        self.window_size = pygame.display.get_window_size()
+        self.mouse_pos = pygame.mouse.get_pos()
+        self.window_active = pygame.display.get_active()
+        self.window_focused = pygame.key.get_focused()
 
     def update(self):
-        nowtime = time.time()
+        nowtime = self.clock()
 
+        advancing = not self.paused and (not self.progression_mode or self.okay_to_progress())
         if self.last_update is not None:
             elapsed = nowtime - self.last_update
-            if not self.paused and (not self.progression_mode or self.okay_to_progress()):
+            if advancing:
                 self.now = self.now + (elapsed * self.timescale)
 
         self.last_update = nowtime
 
-        self.window_size = pygame.display.get_window_size()
-        self.mouse_pos = pygame.mouse.get_pos()
-        self.window_active = pygame.display.get_active()
-        self.window_focused = pygame.key.get_focused()
-        
-        prev_play = None
-        for ev in pygame.event.get():
+        self._poll_window()
+
+        self._restore_play_sounds = None
+        for ev in self.event_source():
             if ev.type == pygame.WINDOWCLOSE:
                 self.is_done = True
                 break
@@ -566,87 +1045,75 @@ class MIDIRenderer():
                         self.save()
                         break
                     else:
-                        self.recording_mode = True
-                        self.now = 0.0
-                        self.timescale = 1.0
-            
-                if ev.key == pygame.K_RIGHT:
-                    self.now += 15
-                    prev_play = self.play_sounds
-                    self.play_sounds = False
-            
-                if ev.key == pygame.K_LEFT:
-                    self.now = max(0, self.now - 15)
-                    prev_play = self.play_sounds
-                    self.play_sounds = False
-                    for k_id in self.keys:
-                        self.keys[k_id].backout_before(self.now)
-                
-                if ev.key == pygame.K_UP:
-                    self.timescale += 0.1
-            
-                if ev.key == pygame.K_DOWN:
-                    self.timescale -= 0.1
-                    self.timescale = max(0.1, self.timescale)
-            
-                if ev.key == pygame.K_1:
-                    self.paused = not self.paused
-                    if self.paused:
-                        pygame.display.set_caption("PAUSED")
-                    else:
-                        pygame.display.set_caption("PLAYING")
-                
-                if ev.key == pygame.K_2:
-                    if self.is_staggered:
-                        self._rearrange()
-                    else:
-                        self._setup_keys()
+                        self.start_recording()
 
-                if ev.key == pygame.K_3:
-                    self.progression_mode = not self.progression_mode
-                
-                if ev.key == pygame.K_p:
-                    self.paused = not self.paused
+                action = self.hotkeys.get(ev.key, None)
+                if action is not None:
+                    action()
             
                 if not self.ignore_keypresses:
-                    for k_id in self.keys:
-                        k = self.keys[k_id]
-                        if k.keyboard_key == ev.key:
-                            k.real_down(was_keypress=True)
+                    k = self.keys_by_keycode.get(ev.key, None)
+                    if k is not None:
+                        k.real_down(was_keypress=True)
             
             elif ev.type == pygame.KEYUP:
                 if not self.ignore_keypresses:
-                    for k_id in self.keys:
-                        k = self.keys[k_id]
-                        if k.keyboard_key == ev.key:
-                            k.real_up(was_keypress=True)
+                    k = self.keys_by_keycode.get(ev.key, None)
+                    if k is not None:
+                        k.real_up(was_keypress=True)
                 
                 if ev.key == pygame.K_p:
-                    self.paused = not self.paused
+                    # Hold P to pause
+                    self.toggle_pause()
+
+        # From the control server, or anything else that needs to run between frames
+        while self.commands:
+            self.commands.popleft()()
+        self.profiler.mark("events")
             
-        if self.in_sounds is not None:
-            toggled_pitches = []
-            if self.in_sounds.poll():
-                midi_events = self.in_sounds.read(10)
-                for ((status, data1, data2, data3), timestamp) in midi_events:
-                    if status == 144:
-                        # Note on / off get jumbled
-                        pitch = data1
-                        velocity = data2
-                        toggled_pitches.append(pitch)
-
-            # Transform pitches as needed
-            for pitch in toggled_pitches:
-                tr = self._transform_pitch(pitch)
-                matching_key = self.keys.get(tr, None)
+        if self.midi_reader is not None:
+            # Already in timestamp order
+            for (_, pitch, is_on) in self.midi_reader.drain():
+                matching_key = self.key_for_midi_input(pitch)
                 if matching_key is not None:
-                    matching_key.real_toggle()
-        
-        for k_id in self.keys:
-            self.keys[k_id].update(self.now)
-
-        if prev_play is not None:
-            self.play_sounds = prev_play
+                    if is_on:
+                        matching_key.real_down()
+                    else:
+                        matching_key.real_up()
+        self.profiler.mark("midi_in")
+
+        if self.watcher is not None:
+            self._apply_library_changes()
+        self._reload_ready_songs()
+        self._splice_ready_songs()
+        self._materialize_until(self.now + self.materialize_window)
+        self._forget_before(self.now - self.materialize_window)
+        self.profiler.mark("songs")
+
+        for ix in self.key_state.due(self.now):
+            self.keys_by_index[ix].update(self.now)
+        self.profiler.mark("keys")
+
+        if self.emitter is not None:
+            self.emitter.publish(self.now, self.timescale, advancing, self.window_focused)
+            self.emitter.set_limits(**self.stroke_limits())
+            if self.recording_plays:
+                self.emitter.schedule(self.keys_by_index, self.now)
+            if self.pending_taps:
+                self.emitter.send_now(self.pending_taps)
+                self.pending_taps = []
+            self.emitter.forward_events(self.emission)
+        elif self.pending_taps:
+            self.governor.set_limits(**self.stroke_limits())
+            priorities = chord_priorities([pitch for (_, pitch) in self.pending_taps])
+            self.governor.submit([(name, prio) for ((name, _), prio) in zip(self.pending_taps, priorities)])
+            self.pending_taps = []
+        elif self.macro_output:
+            self.governor.flush()
+        self.profiler.mark("emit")
+
+        if self._restore_play_sounds is not None:
+            self.play_sounds = self._restore_play_sounds
 
     def norm_pos_to_abs(self, norm_pos: T.Tuple[float, float], rect_size: T.Optional[T.Tuple[int, int]] = None) -> T.Tuple[int, int]:
         if rect_size is None:
@@ -672,42 +1139,110 @@ class MIDIRenderer():
         for k_id in self.keys:
             key = self.keys[k_id]
             key.draw(self.now)
+        if self.show_latency:
+            readout = self.emission.readout(self.emission.song_at(self.now))
+            if readout:
+                display.blit(self.small_font.render(readout, True, FONT_COLOR, None), (4, 4))
+        if self.show_profiler:
+            line_height = self.small_font.get_linesize()
+            for i, line in enumerate(self.profiler.lines()):
+                display.blit(self.small_font.render(line, True, FONT_COLOR, None), (4, 4 + (i + 1) * line_height))
+        self.profiler.mark("draw")
         pygame.display.flip()
+        self.profiler.mark("flip")
 
     def start(self):
         self.now = 0.0
-        if self.macro_output:
+        self.open_midi_ports()
+        if self.emitter is not None:
+            self.emitter.start()
+        elif self.macro_output:
             self.macro.start()
+        if self.midi_reader is not None:
+            self.midi_reader.start()
+        self.midi_out.start()
+        if self.watch_library:
+            # Takes its first snapshot on its own thread, and the index stays lazy
+            self.watcher = LibraryWatcher()
+            self.watcher.start()
+        if self.control_server:
+            from control_server import DEFAULT_PORT, ControlServer
+            port = DEFAULT_PORT if self.control_port is None else self.control_port
+            self.server = ControlServer(self, port=port)
+            self.server.start()
         while True:
+            self.profiler.begin_frame()
             self.update()
             
             if self.is_done:
                 break
 
             self.draw()
+            if not STARTUP.reported:
+                STARTUP.add("first frame", STARTUP.started_at)
+                print(STARTUP.report())
 
-            nowtime = time.time() - self.last_update
             time.sleep(0.01)
-        if self.macro_output:
+            self.profiler.mark("sleep")
+            self.profiler.end_frame()
+        if self.server is not None:
+            self.server.close()
+        if self.profiler.is_capturing:
+            print(f"Wrote profile to {self.profiler.stop_capture()}")
+        if self.midi_reader is not None:
+            self.midi_reader.close()
+        self.midi_out.close()
+        print(self.midi_out.report())
+        self.playlist.close()
+        if self.watcher is not None:
+            self.watcher.close()
+        if self.journal is not None:
+            # Leave the journal on disk so the take can be recovered later
+            self.journal.close()
+        if self.emitter is not None:
+            # Prints its own stroke report, its timings land in self.emission
+            self.emitter.close(self.emission)
+        elif self.macro_output:
+            self.governor.release_all()
+            print(self.governor.report())
             self.macro.close()
+        print(self.emission.report())
+        exported = self.emission.export()
+        if exported is not None:
+            print(f"Wrote emission timings to {exported}.csv / .json")
+
+
+for _setting in fields(GameSettings):
+    setattr(MIDIRenderer, _setting.name, _settings_property(_setting.name))
 
 
 def main():
-    pygame.display.set_mode((800, 480), pygame.RESIZABLE)
-    if MAKE_TRANSPARENT:
-        make_window_transparent()
-    game = MIDIRenderer(preset = GameSettings(
-        transpose_amount=0,
-        play_sounds=True,
-        macro_output=True,
-    ))
+    import argparse
+    parser = argparse.ArgumentParser(description="Play songs on the overlay")
+    parser.add_argument("--control-server", action="store_true", help="Accept commands over a localhost socket, see control_client.py")
+    parser.add_argument("--control-port", type=int, default=None, help="Defaults to 7390")
+    args = parser.parse_args()
+    with STARTUP.phase("window"):
+        pygame.display.init()
+        pygame.display.set_mode((800, 480), pygame.RESIZABLE)
+        if MAKE_TRANSPARENT:
+            make_window_transparent()
+    with STARTUP.phase("renderer"):
+        game = MIDIRenderer(preset = GameSettings(
+            transpose_amount=0,
+            play_sounds=True,
+            macro_output=True,
+            control_server=args.control_server,
+            control_port=args.control_port,
+        ))
     #game.enqueue_file("TWICE_Feel_Special", min_confidence=0)
     #game.enqueue_file("PianoMan", min_confidence=0)
-    game.enqueue_file("EvangelionCruelAngelsThesis", min_confidence=0)
+    with STARTUP.phase("enqueue"):
+        game.enqueue_file("EvangelionCruelAngelsThesis", min_confidence=0)
     #game.enqueue_file("hes_a_pirate_easy")
     #game.enqueue_file("Comptine_Yann_Tiersen")
-    #for each_song in game.known_files:
-    #    game.enqueue_file(each_song)
+    #for each_song in game.library.names():
+    #    game.queue_song(each_song)
     game.start()
 
 
@@ -0,0 +1,361 @@
+import os
+import tempfile
+import time
+import typing as T
+from dataclasses import dataclass, field
+
+import numpy as np
+import pygame
+
+from emission_stats import MIDI
+from headless import VirtualClock, enqueue_song, headless_settings
+from read_notes import STRESS_KINDS, write_stress_song
+from render_notes import GameSettings, MIDIRenderer
+
+# (clock time, song time, key, "down" / "up")
+Stroke = T.Tuple[float, float, str, str]
+# (clock time, song time, pitch, is_on)
+SoundEvent = T.Tuple[float, float, int, bool]
+
+
+def spin(seconds: float):
+    # time.sleep overshoots by far more than a keystroke takes
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        pass
+
+
+class RecordingSender:
+    # Takes the place of InterceptionSender and just writes down what it was asked
+    # to do. Each call first spends `cost` seconds through `spend`, standing in for
+    # what the real sender takes.
+    def __init__(
+        self,
+        game: T.Optional[MIDIRenderer] = None,
+        clock: T.Optional[T.Callable[[], float]] = None,
+        cost: float = 0.0,
+        spend: T.Callable[[float], None] = spin,
+    ):
+        self.game = game
+        self.clock = clock
+        self.cost = cost
+        self.spend = spend
+        self.strokes: T.List[Stroke] = []
+
+    def _song_time(self, now: float) -> float:
+        # The song time when the stroke went out, not when the frame started
+        game = self.game
+        if game is None:
+            return 0.0
+        if game.paused or game.last_update is None:
+            return game.now
+        return game.now + (now - game.last_update) * game.timescale
+
+    def _log(self, key: str, kind: str):
+        if self.cost > 0:
+            self.spend(self.cost)
+        now = self.clock() if self.clock is not None else 0.0
+        self.strokes.append((now, self._song_time(now), key, kind))
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def keyDown(self, key: str):
+        self._log(key, "down")
+
+    def keyUp(self, key: str):
+        self._log(key, "up")
+
+
+class InMemoryMIDIOut:
+    # Synchronous stand-in for MIDIOutputWorker
+    def __init__(self, game: MIDIRenderer):
+        self.game = game
+        self.events: T.List[SoundEvent] = []
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _log(self, note: int, is_on: bool, tag: T.Any):
+        now = self.game.clock()
+        self.events.append((now, self.game.now, note, is_on))
+        if tag is not None:
+            self.game.emission.record(MIDI, str(note), tag, now, now)
+
+    def note_on(self, note: int, velocity: int = 127, channel: int = 0, tag: T.Any = None):
+        self._log(note, True, tag)
+
+    def note_off(self, note: int, velocity: int = 127, channel: int = 0, tag: T.Any = None):
+        self._log(note, False, tag)
+
+    def report(self) -> str:
+        return f"MIDI out: {len(self.events)} messages (in memory)"
+
+
+class ScriptedEvents:
+    # Feeds pygame events to the renderer at given times, in seconds from when it was made
+    def __init__(self, clock: T.Callable[[], float], script: T.Optional[T.List[T.Tuple[float, pygame.event.Event]]] = None):
+        self.clock = clock
+        self.started_at = clock()
+        self.script = sorted(script or [], key=lambda timed: timed[0])
+        self._ix = 0
+
+    def __call__(self) -> T.List[pygame.event.Event]:
+        due: T.List[pygame.event.Event] = []
+        while self._ix < len(self.script) and self.script[self._ix][0] <= self.clock() - self.started_at:
+            due.append(self.script[self._ix][1])
+            self._ix += 1
+        return due
+
+
+def key_event(key: int, down: bool = True) -> pygame.event.Event:
+    return pygame.event.Event(pygame.KEYDOWN if down else pygame.KEYUP, key=key)
+
+
+class SimulatedRenderer(MIDIRenderer):
+    # Always behaves as if the game, not the overlay, has focus
+    def _poll_window(self):
+        self.window_size = pygame.display.get_window_size()
+        self.window_active = True
+        self.window_focused = False
+
+
+@dataclass
+class SimulationResult:
+    strokes: T.List[Stroke] = field(default_factory=list)
+    sounds: T.List[SoundEvent] = field(default_factory=list)
+    n_frames: int = 0
+    song_time: float = 0.0
+    stuck_keys: T.List[str] = field(default_factory=list)
+    # Key -> song times it should go down, from the whole compiled song
+    expected_presses: T.Dict[str, np.ndarray] = field(default_factory=dict)
+    # Taps the governor folded into a press that was still held
+    n_merged: int = 0
+    # Seconds spent in update / draw over the run, zero in virtual time
+    frame_seconds: float = 0.0
+
+    def summary(self) -> str:
+        n_down = sum(1 for stroke in self.strokes if stroke[3] == "down")
+        lines = [
+            f"{self.n_frames} frames, {self.song_time:.2f}s of song",
+            f"{n_down} key presses ({self.n_merged} merged), {len(self.strokes) - n_down} releases, {len(self.sounds)} MIDI messages",
+        ]
+        if self.frame_seconds > 0:
+            lines.append(f"update / draw {self.frame_seconds / max(self.n_frames, 1) * 1000:.2f}ms per frame")
+        if self.stuck_keys:
+            lines.append(f"Stuck keys: {', '.join(self.stuck_keys)}")
+        return "\n".join(lines)
+
+
+def expected_presses(game: MIDIRenderer) -> T.Dict[str, np.ndarray]:
+    # Key -> song times it should go down, from every spliced song's full runs
+    # rather than the materialized window
+    presses: T.Dict[str, T.List[np.ndarray]] = {}
+    for pending in game.song_runs:
+        for (the_key, run) in pending.runs:
+            presses.setdefault(the_key.keyboard_key_name.lower(), []).append(run[::2] + pending.offset)
+    return {key: np.sort(np.concatenate(runs)) for key, runs in presses.items()}
+
+
+def simulate(
+    song: str,
+    fps: float = 100.0,
+    duration: T.Optional[float] = None,
+    script: T.Optional[T.List[T.Tuple[float, pygame.event.Event]]] = None,
+    preset: T.Optional[GameSettings] = None,
+    draw: bool = False,
+    wall_clock: bool = False,
+    sender_cost: float = 0.0,
+) -> SimulationResult:
+    # In virtual time the clock only moves between frames (and by sender_cost
+    # per keystroke), so what is measured is the scheduling alone. wall_clock
+    # runs on the real clock like start(): every frame is drawn and followed by
+    # a 1 / fps sleep, so update, draw and sender cost all make strokes late.
+    pygame.init()
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode((800, 480))
+    virtual = None if wall_clock else VirtualClock()
+    clock: T.Callable[[], float] = time.perf_counter if virtual is None else virtual
+    sender = RecordingSender(clock=clock, cost=sender_cost, spend=spin if virtual is None else virtual.advance)
+    settings = preset or headless_settings(macro_output=True, play_sounds=True)
+    game = SimulatedRenderer(settings, clock=clock, event_source=ScriptedEvents(clock, script), macro=sender)
+    sender.game = game
+    sounds = InMemoryMIDIOut(game)
+    game.midi_out = sounds
+
+    enqueue_song(game, song)
+    result = SimulationResult(expected_presses=expected_presses(game))
+    if duration is None:
+        duration = game.enqueue_at + 1.0
+    frame_time = 1.0 / fps
+
+    game.update()
+    while game.now < duration and not game.is_done:
+        if virtual is None:
+            time.sleep(frame_time)
+            started = time.perf_counter()
+            game.update()
+            game.draw()
+            result.frame_seconds += time.perf_counter() - started
+        else:
+            virtual.advance(frame_time)
+            game.update()
+            if draw:
+                game.draw()
+        result.n_frames += 1
+    # Let the governor release whatever it is still holding
+    if virtual is None:
+        time.sleep(game.min_press_duration + frame_time)
+    else:
+        virtual.advance(game.min_press_duration + frame_time)
+    game.governor.flush()
+
+    result.strokes = sender.strokes
+    result.sounds = sounds.events
+    result.song_time = game.now
+    result.n_merged = game.governor.n_merged
+    result.stuck_keys = sorted(
+        [k.keyboard_key_name for k in game.keys_by_index if k.is_really_down]
+        + [f"{key} (macro)" for key in game.governor.held_keys]
+    )
+    return result
+
+
+@dataclass
+class StressResult:
+    kind: str
+    notes_per_sec: float
+    n_expected: int
+    n_sent: int
+    # Due presses that never got one of their own, less the merged ones
+    n_missed: int
+    # Due presses the governor folded into a press that was still held
+    n_merged: int
+    # Song time of each press minus when it was due
+    errors: np.ndarray
+
+    @property
+    def miss_rate(self) -> float:
+        return self.n_missed / max(self.n_expected, 1)
+
+    @property
+    def merge_rate(self) -> float:
+        return self.n_merged / max(self.n_expected, 1)
+
+    def percentile(self, q: float) -> float:
+        return float(np.percentile(self.errors, q)) if len(self.errors) else float("nan")
+
+    def summary(self) -> str:
+        return (
+            f"{self.kind:>8} {self.notes_per_sec:6g}/s: {self.n_sent:6d} / {self.n_expected:6d} presses, "
+            f"{self.miss_rate * 100:5.1f}% missed, {self.merge_rate * 100:5.1f}% merged, error ms p50 {self.percentile(50) * 1000:6.2f} "
+            f"p90 {self.percentile(90) * 1000:6.2f} p99 {self.percentile(99) * 1000:6.2f} "
+            f"max {(self.errors.max() if len(self.errors) else float('nan')) * 1000:6.2f}"
+        )
+
+
+def match_presses(expected: T.Dict[str, np.ndarray], strokes: T.List[Stroke]) -> T.Tuple[np.ndarray, int]:
+    # Pairs each due press with the first press of that key at or after it, as
+    # long as it comes before the key's next due press. Returns the errors of the
+    # matched ones and how many went unmatched.
+    sent: T.Dict[str, T.List[float]] = {}
+    for (_, song_time, key, kind) in strokes:
+        if kind == "down":
+            sent.setdefault(key, []).append(song_time)
+    errors: T.List[np.ndarray] = []
+    n_missed = 0
+    for key, due in expected.items():
+        if len(due) == 0:
+            continue
+        actual = np.asarray(sent.get(key, []), dtype=np.float64)
+        ix = np.searchsorted(actual, due - 1e-9)
+        candidates = actual[np.minimum(ix, len(actual) - 1)] if len(actual) else np.full(len(due), np.inf)
+        next_due = np.r_[due[1:], np.inf]
+        hit = (ix < len(actual)) & (candidates < next_due)
+        errors.append(candidates[hit] - due[hit])
+        n_missed += int((~hit).sum())
+    return (np.concatenate(errors) if errors else np.zeros(0)), n_missed
+
+
+def stress_test(
+    kinds: T.Sequence[str] = STRESS_KINDS,
+    densities: T.Sequence[float] = (4, 8, 16, 32, 64, 128),
+    seconds: float = 20.0,
+    fps: float = 100.0,
+    preset: T.Optional[GameSettings] = None,
+    wall_clock: bool = False,
+    sender_cost: float = 0.0,
+) -> T.List[StressResult]:
+    # Plays each generated song through the full macro path and compares the
+    # presses the sender saw against the ones the song asked for
+    settings = preset or headless_settings(macro_output=True, play_sounds=True)
+    results: T.List[StressResult] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in kinds:
+            for notes_per_sec in densities:
+                fname = write_stress_song(kind, notes_per_sec, seconds, os.path.join(tmp, f"stress_{kind}_{notes_per_sec:g}.mid"))
+                run = simulate(fname, fps=fps, preset=settings, wall_clock=wall_clock, sender_cost=sender_cost)
+                errors, n_unmatched = match_presses(run.expected_presses, run.strokes)
+                n_expected = sum(len(due) for due in run.expected_presses.values())
+                n_sent = sum(1 for stroke in run.strokes if stroke[3] == "down")
+                n_merged = min(run.n_merged, n_unmatched)
+                results.append(StressResult(kind, notes_per_sec, n_expected, n_sent, n_unmatched - n_merged, n_merged, errors))
+    return results
+
+
+def max_sustainable(results: T.List[StressResult], max_miss_rate: float = 0.01, max_p99: float = 0.02) -> T.Dict[str, T.Optional[float]]:
+    # Per kind, the highest density reached before the first one that lost too
+    # many presses, missed or merged, or was too late
+    best: T.Dict[str, T.Optional[float]] = {}
+    failed: T.Set[str] = set()
+    for result in sorted(results, key=lambda r: (r.kind, r.notes_per_sec)):
+        best.setdefault(result.kind, None)
+        if result.kind in failed:
+            continue
+        if result.miss_rate + result.merge_rate <= max_miss_rate and result.percentile(99) <= max_p99:
+            best[result.kind] = result.notes_per_sec
+        else:
+            failed.add(result.kind)
+    return best
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Play a song through the renderer, in virtual time unless --wall-clock")
+    parser.add_argument("song", nargs="?", help="Library name or path to a .mid / .mscz / .gmsong file")
+    parser.add_argument("--fps", type=float, default=100.0)
+    parser.add_argument("--strokes", action="store_true", help="Print every stroke")
+    parser.add_argument("--stress", action="store_true", help="Run the generated stress songs instead of a song")
+    parser.add_argument("--kind", action="append", choices=STRESS_KINDS, help="Only these stress songs")
+    parser.add_argument("--density", type=float, action="append", help="Notes per second to try")
+    parser.add_argument("--seconds", type=float, default=20.0, help="Length of each stress song")
+    parser.add_argument("--wall-clock", action="store_true", help="Run in real time, drawing every frame")
+    parser.add_argument("--sender-cost", type=float, default=0.0, help="Seconds each keystroke takes to send")
+    args = parser.parse_args()
+    if args.stress:
+        results = stress_test(
+            args.kind or STRESS_KINDS, args.density or (4, 8, 16, 32, 64, 128), args.seconds, args.fps,
+            wall_clock=args.wall_clock, sender_cost=args.sender_cost,
+        )
+        for result in results:
+            print(result.summary())
+        for kind, notes_per_sec in max_sustainable(results).items():
+            print(f"{kind:>8}: sustains {notes_per_sec if notes_per_sec is not None else 'nothing'} notes/s")
+        return
+    if args.song is None:
+        parser.error("Need a song, or --stress")
+    result = simulate(args.song, fps=args.fps, wall_clock=args.wall_clock, sender_cost=args.sender_cost)
+    if args.strokes:
+        for (at, song_time, key, kind) in result.strokes:
+            print(f"{at:10.4f} {song_time:10.4f} {key} {kind}")
+    print(result.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import time
+import typing as T
+from contextlib import contextmanager
+
+# Imported first by render_notes, so this is as close to process start as it gets
+_IMPORTED_AT = time.perf_counter()
+
+
+class StartupTimer:
+    # Nested named phases in the style of `python -X importtime`: each line has
+    # the phase's own time, its time including nested phases, and its name
+    # indented by depth.
+    def __init__(self, started_at: T.Optional[float] = None):
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        # (depth, name, self seconds, cumulative seconds), in the order phases finished
+        self.phases: T.List[T.Tuple[int, str, float, float]] = []
+        self._depth = 0
+        self._child_time: T.List[float] = [0.0]
+        self.reported = False
+
+    @contextmanager
+    def phase(self, name: str) -> T.Iterator[None]:
+        start = time.perf_counter()
+        self._depth += 1
+        self._child_time.append(0.0)
+        try:
+            yield
+        finally:
+            cumulative = time.perf_counter() - start
+            children = self._child_time.pop()
+            self._depth -= 1
+            self._child_time[-1] += cumulative
+            self.phases.append((self._depth, name, cumulative - children, cumulative))
+
+    def add(self, name: str, started_at: float, finished_at: T.Optional[float] = None):
+        # For phases that can't be wrapped in a with block, like module imports
+        cumulative = (finished_at if finished_at is not None else time.perf_counter()) - started_at
+        self._child_time[-1] += cumulative
+        self.phases.append((self._depth, name, cumulative, cumulative))
+
+    def report(self) -> str:
+        self.reported = True
+        lines = ["startup time: self [ms] | cumulative | phase"]
+        for (depth, name, own, cumulative) in self.phases:
+            lines.append(f"startup time: {own * 1000:9.2f} | {cumulative * 1000:10.2f} | {'  ' * depth}{name}")
+        lines.append(f"startup time: {(time.perf_counter() - self.started_at) * 1000:.2f}ms since start")
+        return "\n".join(lines)
+
+
+STARTUP = StartupTimer(_IMPORTED_AT)
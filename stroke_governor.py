@@ -0,0 +1,134 @@
+import math
+import time
+import typing as T
+from collections import Counter
+
+# Key name, priority (higher survives budget cuts)
+TapRequest = T.Tuple[str, float]
+
+NO_LIMITS: T.Dict[str, float] = dict(min_press_duration=0.0, max_strokes_per_sec=math.inf, min_repress_gap=0.0)
+
+
+class StrokeGovernor:
+    # Sits between the timeline and the sender, keeping the strokes within what the
+    # game registers reliably: every press is held for at least min_press_duration,
+    # a key isn't pressed again within min_repress_gap of its release, and presses
+    # come out of a token bucket refilled at max_strokes_per_sec. The defaults
+    # limit nothing: presses are released straight away, like a plain tap.
+    def __init__(
+        self,
+        sender: T.Any,
+        min_press_duration: float = 0.0,
+        max_strokes_per_sec: float = math.inf,
+        min_repress_gap: float = 0.0,
+        max_burst: int = 10,
+        clock: T.Callable[[], float] = time.perf_counter,
+        tracker: T.Any = None,
+    ):
+        self.sender = sender
+        self.set_limits(min_press_duration, max_strokes_per_sec, min_repress_gap)
+        self.max_burst = max_burst
+        self.clock = clock
+        # EmissionTracker, told when each press has gone out
+        self.tracker = tracker
+
+        self._tokens: float = float(max_burst)
+        self._last_refill: T.Optional[float] = None
+        # Key -> when it may be released
+        self._held: T.Dict[str, float] = {}
+        # Key -> when it was released
+        self._released_at: T.Dict[str, float] = {}
+
+        self.n_sent: int = 0
+        self.n_merged: int = 0
+        self.dropped: T.Counter[T.Tuple[str, str]] = Counter()
+
+    def set_limits(self, min_press_duration: float, max_strokes_per_sec: float, min_repress_gap: float):
+        # Can change at any time, the next submit goes by the new limits
+        self.min_press_duration = min_press_duration
+        self.max_strokes_per_sec = max_strokes_per_sec
+        self.min_repress_gap = min_repress_gap
+
+    def _refill(self, now: float):
+        if math.isinf(self.max_strokes_per_sec):
+            self._tokens = float(self.max_burst)
+        elif self._last_refill is not None:
+            self._tokens = min(float(self.max_burst), self._tokens + (now - self._last_refill) * self.max_strokes_per_sec)
+        self._last_refill = now
+
+    def _drop(self, key: str, reason: str):
+        self.dropped[(key, reason)] += 1
+        if self.tracker is not None:
+            self.tracker.key_dropped(key)
+
+    def submit(self, taps: T.List[TapRequest]):
+        now = self.clock()
+        self.flush(now)
+        self._refill(now)
+        pressing: T.List[str] = []
+        for key, _ in sorted(taps, key=lambda tap: tap[1], reverse=True):
+            if key in self._held or key in pressing:
+                # Still sounding from an earlier press, fold this one into it
+                self.n_merged += 1
+                if self.tracker is not None and key not in pressing:
+                    self.tracker.key_dropped(key)
+            elif now - self._released_at.get(key, -float("inf")) < self.min_repress_gap:
+                self._drop(key, "repress")
+            elif math.isinf(self.max_strokes_per_sec):
+                pressing.append(key)
+            elif self._tokens < 1.0:
+                self._drop(key, "budget")
+            else:
+                self._tokens -= 1.0
+                pressing.append(key)
+        for key in pressing:
+            self.sender.keyDown(key)
+            self._held[key] = now + self.min_press_duration
+            if self.tracker is not None:
+                self.tracker.key_sent(key, now, self.clock())
+        self.n_sent += len(pressing)
+        if self.min_press_duration <= 0:
+            # Down, then straight back up
+            self.flush(now)
+
+    def flush(self, now: T.Optional[float] = None):
+        # Release everything that has been held long enough
+        if now is None:
+            now = self.clock()
+        releasing = [key for key, release_at in self._held.items() if release_at <= now]
+        for key in releasing:
+            self.sender.keyUp(key)
+            del self._held[key]
+            self._released_at[key] = now
+
+    def release_all(self):
+        now = self.clock()
+        for key in list(self._held):
+            self.sender.keyUp(key)
+            self._released_at[key] = now
+        self._held.clear()
+
+    @property
+    def held_keys(self) -> T.List[str]:
+        return list(self._held)
+
+    @property
+    def n_dropped(self) -> int:
+        return sum(self.dropped.values())
+
+    def report(self) -> str:
+        lines = [f"Strokes: {self.n_sent} sent, {self.n_merged} merged, {self.n_dropped} dropped"]
+        for (key, reason), count in self.dropped.most_common():
+            lines.append(f"  {key}: {count} dropped ({reason})")
+        return "\n".join(lines)
+
+
+def chord_priorities(pitches: T.List[int]) -> T.List[float]:
+    # Melody (top note) first, then the bass, then inner voices from the top down
+    if not pitches:
+        return []
+    highest, lowest = max(pitches), min(pitches)
+    return [
+        1000.0 + p if p == highest else 500.0 + p if p == lowest else float(p)
+        for p in pitches
+    ]
@@ -0,0 +1,93 @@
+import typing as T
+from bisect import bisect_right
+
+import numpy as np
+
+
+class Timeline:
+    # A key's toggle times, stored as segments that are each (values, offset).
+    # Songs add read-only arrays (possibly views of a memory-mapped file) with the
+    # time they were enqueued at, recordings append to a plain list at the end.
+    # Old segments can be dropped; indexes stay absolute, starting at first_index.
+    def __init__(self):
+        self._segments: T.List[T.Tuple[T.Union[np.ndarray, T.List[float]], float]] = []
+        self._starts: T.List[int] = []
+        self._len: int = 0
+        self._first: int = 0
+        self._tail: T.Optional[T.List[float]] = None
+        self._last_seg: int = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    @property
+    def first_index(self) -> int:
+        return self._first
+
+    def _find_segment(self, ix: int) -> int:
+        seg = self._last_seg
+        if seg < len(self._starts) and self._starts[seg] <= ix and (seg + 1 == len(self._starts) or ix < self._starts[seg + 1]):
+            return seg
+        seg = bisect_right(self._starts, ix) - 1
+        self._last_seg = seg
+        return seg
+
+    def __getitem__(self, ix: int) -> float:
+        if ix < 0:
+            ix += self._len
+        if ix < self._first or ix >= self._len:
+            raise IndexError("Timeline index out of range")
+        seg = self._find_segment(ix)
+        values, offset = self._segments[seg]
+        return float(values[ix - self._starts[seg]]) + offset
+
+    def __iter__(self) -> T.Iterator[float]:
+        for values, offset in self._segments:
+            for value in values:
+                yield float(value) + offset
+
+    def add_segment(self, values: T.Union[np.ndarray, T.List[float]], offset: float = 0.0):
+        if len(values) == 0:
+            return
+        self._segments.append((values, offset))
+        self._starts.append(self._len)
+        self._len += len(values)
+        self._tail = None
+
+    def append(self, when: float):
+        if self._tail is None:
+            self._tail = []
+            self._segments.append((self._tail, 0.0))
+            self._starts.append(self._len)
+        self._tail.append(when)
+        self._len += 1
+
+    def drop_before(self, when: float, keep_from_ix: int) -> bool:
+        # Forget whole segments that end before `when` and before `keep_from_ix`,
+        # returns whether any went
+        n_drop = 0
+        while n_drop < len(self._segments):
+            values, offset = self._segments[n_drop]
+            seg_end = self._starts[n_drop + 1] if n_drop + 1 < len(self._starts) else self._len
+            if values is self._tail or seg_end > keep_from_ix or float(values[-1]) + offset >= when:
+                break
+            n_drop += 1
+        if n_drop:
+            self._first = self._starts[n_drop] if n_drop < len(self._starts) else self._len
+            del self._segments[:n_drop]
+            del self._starts[:n_drop]
+            self._last_seg = 0
+        return n_drop > 0
+
+    def clear(self):
+        self._segments.clear()
+        self._starts.clear()
+        self._len = 0
+        self._first = 0
+        self._tail = None
+        self._last_seg = 0
+
+    def to_array(self) -> np.ndarray:
+        if not self._segments:
+            return np.zeros(0, dtype=np.float64)
+        return np.concatenate([np.asarray(values, dtype=np.float64) + offset for values, offset in self._segments])